@@ -1,20 +1,29 @@
 import argparse
+import logging
 import sys
 from typing import Optional
 
 from PySide6 import QtWidgets
 
+from battle_map_tv.image_cache import default_budget
+from battle_map_tv.package import convert_directory
+from battle_map_tv.scan import scan_directory
 from battle_map_tv.window_gui import GuiWindow
 from battle_map_tv.window_image import ImageWindow
 
 
-def main(default_directory: Optional[str]):
+def main(default_directory: Optional[str], image_cache_budget: int, display_resolution: bool):
     app = QtWidgets.QApplication([])
 
     screens = app.screens()
 
-    image_window = ImageWindow()
+    image_window = ImageWindow(
+        image_cache_budget=image_cache_budget,
+        display_resolution=display_resolution,
+    )
     image_window.resize(800, 600)
+    # don't wait for maps that are read in advance before exiting
+    app.aboutToQuit.connect(image_window.image_cache.cancel_prefetch)
 
     gui_window = GuiWindow(
         image_window=image_window,
@@ -45,6 +54,81 @@ if __name__ == "__main__":
         required=False,
         help="Path to your maps",
     )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=default_budget // 2**20,
+        help="Memory in MB for recently shown maps and the maps next to the shown one",
+    )
+    parser.add_argument(
+        "--display-resolution",
+        action="store_true",
+        help="Read big maps at the resolution of the window, and fully only when zoomed in",
+    )
+    parser.add_argument(
+        "--verbose",
+        "-v",
+        action="store_true",
+        help="Log the steps and timings of the scale detection",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    parser_scan = subparsers.add_parser(
+        "scan",
+        help="Detect the scale of all images in a directory, so autoscale is instant",
+    )
+    parser_scan.add_argument("directory", type=str, help="Path to your maps")
+    parser_scan.add_argument(
+        "--processes",
+        "-p",
+        type=int,
+        required=False,
+        help="Number of images to scan in parallel, default the number of CPUs",
+    )
+    parser_scan.add_argument(
+        "--rescan",
+        action="store_true",
+        help="Also scan images that were scanned before",
+    )
+    parser_scan.add_argument(
+        "--memory-cap",
+        type=int,
+        required=False,
+        help="Memory in MB per process, bigger images are scanned on a sample of tiles",
+    )
+    parser_package = subparsers.add_parser(
+        "package",
+        help="Convert all images in a directory to packages, which open instantly",
+    )
+    parser_package.add_argument("directory", type=str, help="Path to your maps")
+    parser_package.add_argument(
+        "--output",
+        "-o",
+        type=str,
+        required=False,
+        help="Directory for the packages, default next to the images",
+    )
+    parser_package.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Also convert images of which the package is up to date",
+    )
     args = parser.parse_args()
 
-    main(default_directory=args.default_directory)
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+    if args.command == "scan":
+        scan_directory(
+            args.directory,
+            processes=args.processes,
+            rescan=args.rescan,
+            memory_cap=None if args.memory_cap is None else args.memory_cap * 2**20,
+        )
+    elif args.command == "package":
+        convert_directory(args.directory, output_directory=args.output, rebuild=args.rebuild)
+    else:
+        main(
+            default_directory=args.default_directory,
+            image_cache_budget=args.cache_size * 2**20,
+            display_resolution=args.display_resolution,
+        )
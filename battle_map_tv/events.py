@@ -5,6 +5,7 @@ from typing import Callable, Dict
 class EventKeys(Enum):
     change_scale = "change_scale"
     toggle_grid = "toggle_grid"
+    no_grid_found = "no_grid_found"
 
 
 class EventDispatcher:
@@ -1,12 +1,22 @@
+import dataclasses
+import math
 import os.path
-from typing import Tuple
+from functools import partial
+from typing import List, Optional, Tuple
 
-from PySide6.QtGui import QPixmap
-from PySide6.QtWidgets import QGraphicsPixmapItem, QGraphicsScene
+from PySide6.QtCore import QPointF, QRect, QRectF, QSize, Qt
+from PySide6.QtGui import QImage, QImageIOHandler, QImageReader
+from PySide6.QtWidgets import QGraphicsScene
 
 from battle_map_tv.events import global_event_dispatcher, EventKeys
 from battle_map_tv.grid import Grid
-from battle_map_tv.scale_detection import find_image_scale
+from battle_map_tv.scale_cache import detect_image_scale_cached
+from battle_map_tv.scale_detection import (
+    ScaleDetectionResult,
+    SearchHint,
+    detect_array_scale,
+)
+from battle_map_tv.search_history import add_to_search_history, get_search_hint
 from battle_map_tv.storage import (
     set_image_in_storage,
     ImageKeys,
@@ -14,16 +24,107 @@ from battle_map_tv.storage import (
     set_in_storage,
     StorageKeys,
 )
+from battle_map_tv.tiled_image import TiledImageItem, TileLevel, level_region
+from battle_map_tv.utils import array_formats, qimage_to_array
+from battle_map_tv.workers import ProgressCallback, Worker
+
+
+# longest side in pixels of the preview that's shown while a map is read
+preview_size = 1024
+
+
+def read_image(
+    image_path: str,
+    size: Optional[QSize] = None,
+    progress: Optional[ProgressCallback] = None,
+) -> QImage:
+    """Read an image, scaled to `size` if it's given.
+
+    Formats like JPEG can be read at a lower resolution faster, others are read at full
+    resolution and scaled after.
+    """
+    # maps are often bigger than the default limit of 256 MB
+    QImageReader.setAllocationLimit(0)
+    reader = QImageReader(image_path)
+    if size is not None:
+        reader.setScaledSize(size)
+    image = reader.read()
+    if image.isNull():
+        raise ValueError(f"Can't read {image_path}: {reader.errorString()}")
+    return image
+
+
+def read_preview(image_path: str, progress: Optional[ProgressCallback] = None) -> QImage:
+    size = QImageReader(image_path).size()
+    size = size.scaled(preview_size, preview_size, Qt.AspectRatioMode.KeepAspectRatio)
+    return read_image(image_path, size=size)
+
+
+class CustomGraphicsPixmapItem(TiledImageItem):
+    """The map, which is read in the background.
 
+    Until the image is read, a preview is shown if the format can be read at a lower resolution
+    quickly, like JPEG. Otherwise nothing is shown, but the item has the size of the image already.
+    Pass the `levels` of the image if they were read before.
+    """
 
-class CustomGraphicsPixmapItem(QGraphicsPixmapItem):
-    def __init__(self, image_path: str):
-        pixmap = QPixmap(image_path)
-        super().__init__(pixmap)
+    def __init__(self, image_path: str, levels: Optional[List[TileLevel]] = None):
+        self.image_path = image_path
+        self._load_workers: List[Worker] = []
+        self._full_resolution_started = False
+        size = QImageReader(image_path).size()
+        if levels is not None:
+            super().__init__(QImage())
+            self.set_levels(levels)
+        elif not size.isValid():
+            # the size isn't in the header of the file
+            super().__init__(read_image(image_path))
+        else:
+            super().__init__(QImage(), size=size)
         self.image_filename = os.path.basename(image_path)
         self.setFlag(self.GraphicsItemFlag.ItemIsMovable)
         self.setFlag(self.GraphicsItemFlag.ItemSendsGeometryChanges)
-        self.setTransformOriginPoint(pixmap.width() / 2, pixmap.height() / 2)
+        self.setTransformOriginPoint(self.width() / 2, self.height() / 2)
+
+    def start_loading(self, display_resolution: bool = False):
+        """Start reading the image in the background, if it isn't read already.
+
+        With `display_resolution`, a scaled down image is read at the resolution needed for the
+        current scale. The full resolution is only read when the image is zoomed in past that.
+        """
+        if not self.is_preview():
+            return
+        scale = self.scale()
+        if display_resolution and scale < 1:
+            size = QSize(math.ceil(self.width() * scale), math.ceil(self.height() * scale))
+            self._start_loading(partial(read_image, self.image_path, size), size=self.image_size)
+            return
+        reader = QImageReader(self.image_path)
+        if reader.supportsOption(QImageIOHandler.ImageOption.ScaledSize):
+            self._start_loading(partial(read_preview, self.image_path), size=self.image_size)
+        self.more_detail_needed()
+
+    def more_detail_needed(self):
+        if not self._full_resolution_started:
+            self._full_resolution_started = True
+            self._start_loading(partial(read_image, self.image_path))
+
+    def _start_loading(self, fn, size: Optional[QSize] = None):
+        worker = Worker(fn)
+
+        def callback(image: QImage):
+            # a smaller image can come in after a bigger one
+            if not worker.is_cancelled() and image.width() > self.levels[0].width:
+                self.set_image(image, size=size)
+
+        worker.signals.result.connect(callback)
+        self._load_workers.append(worker.start())
+
+    def cancel_loading(self):
+        for worker in self._load_workers:
+            worker.cancel()
+        self._load_workers = []
+        self.cancel_pyramid()
 
     def wheelEvent(self, event):
         self.set_scale(self.scale() + event.delta() / 1500)
@@ -34,15 +135,15 @@ class CustomGraphicsPixmapItem(QGraphicsPixmapItem):
 
     def set_position(self, position: Tuple[int, int]):
         self.setPos(
-            position[0] - self.pixmap().width() // 2,
-            position[1] - self.pixmap().height() // 2,
+            position[0] - self.width() // 2,
+            position[1] - self.height() // 2,
         )
         self.store_position()
 
     def store_position(self):
         position = (
-            self.pos().x() + self.pixmap().width() // 2,
-            self.pos().y() + self.pixmap().height() // 2,
+            self.pos().x() + self.width() // 2,
+            self.pos().y() + self.height() // 2,
         )
         set_image_in_storage(self.image_filename, ImageKeys.position, position)
 
@@ -59,6 +160,10 @@ class Image:
         scene: QGraphicsScene,
         window_width_px: int,
         window_height_px: int,
+        grid: Optional[Grid] = None,
+        levels: Optional[List[TileLevel]] = None,
+        pixmap_item: Optional[CustomGraphicsPixmapItem] = None,
+        display_resolution: bool = False,
     ):
         self.rotation = 0
 
@@ -68,8 +173,11 @@ class Image:
         set_in_storage(key=StorageKeys.previous_image, value=image_path)
 
         self.scene = scene
+        self._autoscale_worker: Optional[Worker] = None
 
-        self.pixmap_item = CustomGraphicsPixmapItem(image_path)
+        if pixmap_item is None:
+            pixmap_item = CustomGraphicsPixmapItem(image_path, levels=levels)
+        self.pixmap_item = pixmap_item
         self.scene.addItem(self.pixmap_item)
 
         try:
@@ -91,12 +199,20 @@ class Image:
                 )
             )
         except KeyError:
-            new_scale = min(
-                window_width_px / self.pixmap_item.pixmap().width(),
-                window_height_px / self.pixmap_item.pixmap().height(),
+            px_per_inch = get_image_from_storage(
+                self.image_filename,
+                ImageKeys.px_per_inch,
+                default=None,
             )
-            if new_scale < 1.0:
-                self.scale(new_scale)
+            if grid is not None and px_per_inch is not None:
+                self.scale(grid.pixels_per_square / px_per_inch)
+            else:
+                new_scale = min(
+                    window_width_px / self.pixmap_item.width(),
+                    window_height_px / self.pixmap_item.height(),
+                )
+                if new_scale < 1.0:
+                    self.scale(new_scale)
         else:
             global_event_dispatcher.dispatch_event(EventKeys.change_scale, self._scale)
 
@@ -110,7 +226,12 @@ class Image:
         else:
             self.pixmap_item.set_position(position)
 
+        # the scale is known now, to read the image at the resolution it needs
+        self.pixmap_item.start_loading(display_resolution=display_resolution)
+
     def delete(self):
+        self.cancel_autoscale()
+        self.pixmap_item.cancel_loading()
         self.scene.removeItem(self.pixmap_item)
 
     def center(self):
@@ -125,7 +246,147 @@ class Image:
     def scale(self, value: float):
         self.pixmap_item.set_scale(value)
 
-    def autoscale(self, grid: Grid):
-        image_px_per_square = find_image_scale(self.filepath)
-        scale = grid.pixels_per_square / image_px_per_square
-        self.scale(scale)
+    def autoscale(self, grid: Grid, region: Optional[QRectF] = None) -> Optional[Worker]:
+        """Scale the image to the grid, returns the worker if the scale needs to be detected.
+
+        With a `region`, a rectangle in scene coordinates, the scale is detected on the part of
+        the image within it, also when the scale was detected before. Nothing happens when the
+        region is outside the image.
+        """
+        self.cancel_autoscale()
+        if region is None:
+            px_per_inch = get_image_from_storage(
+                self.image_filename, ImageKeys.px_per_inch, default=None
+            )
+            # when no grid was found before, detect again, it can have been a false negative
+            if px_per_inch is not None:
+                self._apply_px_per_inch(px_per_inch, grid=grid)
+                return None
+            # detect on the pixels of the tiles instead of decoding the file again
+            level = None if self.pixmap_item.is_preview() else self.pixmap_item.levels[0]
+            worker = Worker(partial(_detect_level_scale, self.filepath, level, get_search_hint()))
+        else:
+            # the region in pixels of the image, which can be scaled and rotated
+            crop = self.pixmap_item.mapFromScene(region).boundingRect().toAlignedRect()
+            crop = crop.intersected(self.pixmap_item.rect())
+            if crop.isEmpty():
+                return None
+            if self.pixmap_item.is_preview():
+                fn = partial(_detect_file_region_scale, self.filepath, crop, get_search_hint())
+            else:
+                qimage = self.pixmap_item.to_image(crop)
+                offset = (crop.x(), crop.y())
+                fn = partial(_detect_qimage_region_scale, qimage, offset, get_search_hint())
+            worker = Worker(fn)
+
+        def callback(result: ScaleDetectionResult):
+            if not worker.is_cancelled():
+                add_to_search_history([result])
+                # None means the image has no grid
+                px_per_inch = result.px_per_inch if result.grid_found else None
+                # a region without a grid doesn't mean the rest of the image has none
+                if px_per_inch is not None or region is None:
+                    set_image_in_storage(self.image_filename, ImageKeys.px_per_inch, px_per_inch)
+                    phase = (result.phase_x, result.phase_y)
+                    set_image_in_storage(self.image_filename, ImageKeys.grid_phase, phase)
+                self._apply_px_per_inch(px_per_inch, grid=grid)
+
+        worker.signals.result.connect(callback)
+        self._autoscale_worker = worker.start()
+        return worker
+
+    def _apply_px_per_inch(self, px_per_inch: Optional[float], grid: Grid):
+        if px_per_inch is None:
+            global_event_dispatcher.dispatch_event(EventKeys.no_grid_found)
+            return
+        self.scale(grid.pixels_per_square / px_per_inch)
+        phase = get_image_from_storage(self.image_filename, ImageKeys.grid_phase, default=None)
+        if phase is not None:
+            self.align_to_grid(phase=phase, px_per_inch=px_per_inch, grid=grid)
+
+    def align_to_grid(
+        self,
+        phase: Tuple[Optional[float], Optional[float]],
+        px_per_inch: float,
+        grid: Grid,
+    ):
+        """Move the image so that the grid lines on it are on the lines of the grid overlay."""
+        image_size = (self.pixmap_item.width(), self.pixmap_item.height())
+        # take the lines closest to the middle, so any error in the spacing is spread evenly
+        point = [0.0, 0.0]
+        for i, (p, size) in enumerate(zip(phase, image_size)):
+            if p is not None:
+                point[i] = p + round((size / 2 - p) / px_per_inch) * px_per_inch
+        scene_point = self.pixmap_item.mapToScene(QPointF(*point))
+        delta = [
+            grid._snap(p=p, offset=offset, ppi=grid.pixels_per_square, divide_by=1) - p
+            for p, offset in zip((scene_point.x(), scene_point.y()), grid.offset)
+        ]
+        # with a rotation of 90 or 270 degrees, the x axis of the image is the y axis on screen
+        swapped = self.rotation % 180 != 0
+        for i in (0, 1):
+            if phase[i] is None:
+                delta[1 - i if swapped else i] = 0.0
+        self.pixmap_item.setPos(self.pixmap_item.pos() + QPointF(*delta))
+        self.pixmap_item.store_position()
+
+    def cancel_autoscale(self):
+        if self._autoscale_worker is not None:
+            self._autoscale_worker.cancel()
+            self._autoscale_worker = None
+
+
+def _detect_level_scale(
+    image_path: str,
+    level: Optional[TileLevel],
+    hint: Optional[SearchHint] = None,
+    progress: Optional[ProgressCallback] = None,
+) -> ScaleDetectionResult:
+    if level is None:
+        # the image isn't read yet, so it's read for the detection
+        return detect_image_scale_cached(image_path, progress=progress, hint=hint)
+    # the tiles are only copied into one array when the result isn't cached, in grey like the
+    # detection uses them
+    return detect_image_scale_cached(
+        image_path,
+        progress=progress,
+        image=partial(level_region, level, QRect(0, 0, level.width, level.height), grey=True),
+        hint=hint,
+    )
+
+
+def _detect_qimage_region_scale(
+    qimage: QImage,
+    offset: Tuple[int, int],
+    hint: Optional[SearchHint] = None,
+    progress: Optional[ProgressCallback] = None,
+) -> ScaleDetectionResult:
+    """Detect the scale on a part of an image, at `offset` in pixels from its top left."""
+    if qimage.format() not in array_formats:
+        qimage = qimage.convertToFormat(QImage.Format.Format_RGB32)
+    # a part of the image isn't cached, that's only done for the image file as a whole
+    result = detect_array_scale(qimage_to_array(qimage), progress=progress, hint=hint)
+    x, y = offset
+    # positions in the whole image
+    return dataclasses.replace(
+        result,
+        rhos_horizontal=[rho + y for rho in result.rhos_horizontal],
+        rhos_vertical=[rho + x for rho in result.rhos_vertical],
+        phase_x=None if result.phase_x is None else (result.phase_x + x) % result.px_per_inch,
+        phase_y=None if result.phase_y is None else (result.phase_y + y) % result.px_per_inch,
+    )
+
+
+def _detect_file_region_scale(
+    image_path: str,
+    crop: QRect,
+    hint: Optional[SearchHint] = None,
+    progress: Optional[ProgressCallback] = None,
+) -> ScaleDetectionResult:
+    reader = QImageReader(image_path)
+    reader.setClipRect(crop)
+    qimage = reader.read()
+    if qimage.isNull():
+        raise ValueError(f"Can't read {image_path}: {reader.errorString()}")
+    offset = (crop.x(), crop.y())
+    return _detect_qimage_region_scale(qimage, offset, hint=hint, progress=progress)
@@ -0,0 +1,117 @@
+import os
+import os.path
+from functools import partial
+from typing import Dict, List, Optional, OrderedDict, Tuple
+
+from PySide6.QtGui import QImageReader
+
+from battle_map_tv.image import read_image
+from battle_map_tv.scan import image_extensions
+from battle_map_tv.tiled_image import TileLevel, build_level, build_pyramid
+from battle_map_tv.workers import ProgressCallback, Worker
+
+# memory in bytes for maps that aren't shown, set it with --cache-size
+default_budget = 1024 * 2**20
+# number of images before and after the shown image in its directory that are read in advance
+n_neighbours = 1
+
+
+def read_levels(image_path: str, progress: Optional[ProgressCallback] = None) -> List[TileLevel]:
+    level = build_level(read_image(image_path))
+    return [level] + build_pyramid(level, progress=progress)
+
+
+def levels_size(levels: List[TileLevel]) -> int:
+    return sum(tile.sizeInBytes() for level in levels for row in level.tiles for tile in row)
+
+
+def estimated_size(image_path: str) -> Optional[int]:
+    """The bytes the levels of an image will take, from the size in the header of the file."""
+    size = QImageReader(image_path).size()
+    if not size.isValid():
+        return None
+    # 32 bits per pixel, and the smaller levels take a third of the first one
+    return size.width() * size.height() * 4 * 4 // 3
+
+
+def neighbours(image_path: str) -> List[str]:
+    """The images next to this one in its directory, in alphabetical order."""
+    directory, filename = os.path.split(os.path.abspath(image_path))
+    filenames = sorted(f for f in os.listdir(directory) if f.lower().endswith(image_extensions))
+    try:
+        i = filenames.index(filename)
+    except ValueError:
+        return []
+    nearby = filenames[max(i - n_neighbours, 0) : i] + filenames[i + 1 : i + 1 + n_neighbours]
+    return [os.path.join(directory, f) for f in nearby]
+
+
+def _modified(image_path: str) -> Optional[int]:
+    try:
+        return os.stat(image_path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class ImageCache:
+    """The tiles of recently shown maps, so they can be shown again without reading the file.
+
+    When the maps take more than `budget` bytes, the least recently used are dropped.
+    """
+
+    def __init__(self, budget: int = default_budget):
+        self.budget = budget
+        self.entries: OrderedDict[str, Tuple[Optional[int], List[TileLevel]]] = OrderedDict()
+        self._prefetch_workers: Dict[str, Worker] = {}
+
+    def size(self) -> int:
+        return sum(levels_size(levels) for _, levels in self.entries.values())
+
+    def put(self, image_path: str, levels: List[TileLevel]):
+        image_path = os.path.abspath(image_path)
+        self.entries.pop(image_path, None)
+        if levels_size(levels) > self.budget:
+            return
+        self.entries[image_path] = (_modified(image_path), levels)
+        while self.size() > self.budget:
+            self.entries.popitem(last=False)
+
+    def pop(self, image_path: str) -> Optional[List[TileLevel]]:
+        """Take the tiles of a map out of the cache, because it's shown again."""
+        image_path = os.path.abspath(image_path)
+        try:
+            modified, levels = self.entries.pop(image_path)
+        except KeyError:
+            return None
+        if modified is None or modified != _modified(image_path):
+            # the file changed since it was read
+            return None
+        return levels
+
+    def prefetch(self, image_path: str):
+        """Read the images next to this one in the background."""
+        paths = [
+            path
+            for path in neighbours(image_path)
+            if path not in self.entries
+            # it would be dropped by put right after decoding it
+            and (estimated_size(path) or 0) <= self.budget
+        ]
+        for path in list(self._prefetch_workers):
+            if path not in paths:
+                self._prefetch_workers.pop(path).cancel()
+        for path in paths:
+            if path not in self._prefetch_workers:
+                worker = Worker(partial(read_levels, path))
+                worker.signals.result.connect(partial(self._prefetched, path, worker))
+                self._prefetch_workers[path] = worker.start()
+
+    def _prefetched(self, image_path: str, worker: Worker, levels: List[TileLevel]):
+        if not worker.is_cancelled():
+            self._prefetch_workers.pop(image_path, None)
+            self.put(image_path, levels)
+
+    def cancel_prefetch(self):
+        for worker in self._prefetch_workers.values():
+            worker.cancel()
+        self._prefetch_workers = {}
@@ -0,0 +1,225 @@
+import json
+import os
+import os.path
+import struct
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from PySide6.QtCore import Qt
+from PySide6.QtGui import QImage
+
+from battle_map_tv.image import read_image
+from battle_map_tv.scale_cache import image_hash
+from battle_map_tv.scan import find_images
+from battle_map_tv.storage import ImageKeys, get_image_from_storage, set_image_in_storage
+from battle_map_tv.tiled_image import TileLevel, build_level, build_pyramid
+from battle_map_tv.utils import qimage_to_array
+
+package_extension = ".bmtv"
+magic = b"BMTV"
+# increase when the layout of the file changes
+package_version = 1
+# the pixels start at multiples of this, so they can be mapped in memory page by page
+alignment = 4096
+# longest side in pixels of the thumbnail
+thumbnail_size = 256
+
+# the file starts with the magic bytes, the version and the length of the JSON header, which has
+# the sizes and offsets of the pixels of the tiles and the thumbnail
+_prefix = struct.Struct("<4sII")
+
+
+@dataclass
+class Package:
+    """A map with its tiles at every level of detail, ready to show."""
+
+    levels: List[TileLevel]
+    thumbnail: QImage
+    # of the image file the package was made from
+    source_hash: str
+    # values of ImageKeys, like the detected scale
+    settings: Dict[str, Any]
+
+
+def is_package(path: str) -> bool:
+    return path.lower().endswith(package_extension)
+
+
+def _align(offset: int) -> int:
+    return -(-offset // alignment) * alignment
+
+
+def write_package(package_path: str, package: Package):
+    images: List[QImage] = []
+
+    def add_image(image: QImage) -> Dict[str, int]:
+        images.append(image)
+        return {"width": image.width(), "height": image.height()}
+
+    header = {
+        "format": package.levels[0].format.value,
+        "source_hash": package.source_hash,
+        "settings": package.settings,
+        "thumbnail": add_image(package.thumbnail),
+        "levels": [
+            {
+                "width": level.width,
+                "height": level.height,
+                "tiles": [[add_image(tile) for tile in row] for row in level.tiles],
+            }
+            for level in package.levels
+        ],
+    }
+    # the offsets are in the header, so the length of the header depends on them
+    sizes = [image.width() * image.height() * 4 for image in images]
+    offsets: List[int] = []
+    header_bytes = b""
+    while not offsets or _align(_prefix.size + len(header_bytes)) != offsets[0]:
+        offset = _align(_prefix.size + len(header_bytes))
+        offsets = []
+        for size in sizes:
+            offsets.append(offset)
+            offset = _align(offset + size)
+        for entry, image_offset in zip(_image_entries(header), offsets):
+            entry["offset"] = image_offset
+        header_bytes = json.dumps(header).encode()
+    # write to a temporary file, so an interrupted conversion doesn't leave a broken package
+    tmp_path = package_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_prefix.pack(magic, package_version, len(header_bytes)))
+        f.write(header_bytes)
+        for image, offset in zip(images, offsets):
+            f.seek(offset)
+            f.write(qimage_to_array(image).tobytes())
+        f.truncate(_align(f.tell()))
+    os.replace(tmp_path, package_path)
+
+
+def _image_entries(header: Dict[str, Any]) -> List[Dict[str, int]]:
+    """The entries of the header for images, in the order of the pixels in the file."""
+    entries = [header["thumbnail"]]
+    for level in header["levels"]:
+        entries.extend(entry for row in level["tiles"] for entry in row)
+    return entries
+
+
+def _read_header(package_path: str) -> Dict[str, Any]:
+    with open(package_path, "rb") as f:
+        file_magic, version, header_length = _prefix.unpack(f.read(_prefix.size))
+        if file_magic != magic:
+            raise ValueError(f"{package_path} isn't a battle map package")
+        if version != package_version:
+            raise ValueError(f"{package_path} is a package of version {version}, convert it again")
+        return json.loads(f.read(header_length))
+
+
+def read_package(package_path: str) -> Package:
+    """Open a package, the pixels are mapped in memory and only read from disk when they're used."""
+    header = _read_header(package_path)
+    image_format = QImage.Format(header["format"])
+    data = np.memmap(package_path, mode="r")
+
+    def view(entry: Dict[str, int]) -> QImage:
+        width, height = entry["width"], entry["height"]
+        pixels = data[entry["offset"] : entry["offset"] + width * height * 4]
+        # the QImage keeps a reference to the pixels, which keeps the file mapped
+        return QImage(pixels.data, width, height, width * 4, image_format)
+
+    return Package(
+        levels=[
+            TileLevel(
+                level["width"],
+                level["height"],
+                image_format,
+                [[view(entry) for entry in row] for row in level["tiles"]],
+            )
+            for level in header["levels"]
+        ],
+        thumbnail=view(header["thumbnail"]),
+        source_hash=header["source_hash"],
+        settings=header["settings"],
+    )
+
+
+def settings_from_storage(image_filename: str) -> Dict[str, Any]:
+    settings = {}
+    for key in ImageKeys:
+        value = get_image_from_storage(image_filename, key, default=None)
+        if value is not None:
+            settings[key.value] = value
+    return settings
+
+
+def settings_to_storage(image_filename: str, settings: Dict[str, Any]):
+    """Save the settings of a package in storage, unless the map has its own already."""
+    for key in ImageKeys:
+        if key.value in settings and get_image_from_storage(image_filename, key, None) is None:
+            set_image_in_storage(image_filename, key, settings[key.value])
+
+
+def convert_image(image_path: str, package_path: str):
+    """Make a package of an image file, with the settings it has in storage."""
+    level = build_level(read_image(image_path))
+    levels = [level] + build_pyramid(level)
+    # the smallest level is a single tile
+    thumbnail = levels[-1].tiles[0][0]
+    if max(thumbnail.width(), thumbnail.height()) > thumbnail_size:
+        thumbnail = thumbnail.scaled(
+            thumbnail_size,
+            thumbnail_size,
+            Qt.AspectRatioMode.KeepAspectRatio,
+            Qt.TransformationMode.SmoothTransformation,
+        )
+    package = Package(
+        levels=levels,
+        thumbnail=thumbnail,
+        source_hash=image_hash(image_path),
+        settings=settings_from_storage(os.path.basename(image_path)),
+    )
+    write_package(package_path, package)
+
+
+def _is_up_to_date(package_path: str, image_path: str) -> bool:
+    try:
+        header = _read_header(package_path)
+    except (OSError, ValueError, struct.error):
+        return False
+    return header["source_hash"] == image_hash(image_path)
+
+
+def convert_directory(
+    directory: str,
+    output_directory: Optional[str] = None,
+    rebuild: bool = False,
+) -> List[str]:
+    """Make packages of all images in a directory, next to them or in `output_directory`.
+
+    Images of which the package is up to date are skipped, unless `rebuild` is set.
+    """
+    package_paths = []
+    image_paths = find_images(directory)
+    print(f"Converting {len(image_paths)} images in {directory}")
+    for i, image_path in enumerate(image_paths, start=1):
+        if output_directory is None:
+            package_dir = os.path.dirname(image_path)
+        else:
+            relative_dir = os.path.relpath(os.path.dirname(image_path), directory)
+            package_dir = os.path.normpath(os.path.join(output_directory, relative_dir))
+            os.makedirs(package_dir, exist_ok=True)
+        package_path = os.path.join(
+            package_dir, os.path.splitext(os.path.basename(image_path))[0] + package_extension
+        )
+        if not rebuild and _is_up_to_date(package_path, image_path):
+            print(f"[{i}/{len(image_paths)}] {image_path}: up to date")
+        else:
+            try:
+                convert_image(image_path, package_path)
+            except Exception as e:
+                print(
+                    f"[{i}/{len(image_paths)}] {image_path}: failed, {str(e) or type(e).__name__}"
+                )
+                continue
+            print(f"[{i}/{len(image_paths)}] {image_path}: {package_path}")
+        package_paths.append(package_path)
+    return package_paths
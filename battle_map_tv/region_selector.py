@@ -0,0 +1,61 @@
+from typing import Optional, Callable
+
+from PySide6.QtCore import QPointF, QRectF
+from PySide6.QtGui import QColor, QMouseEvent, QPen, Qt
+from PySide6.QtWidgets import QGraphicsRectItem, QGraphicsScene
+
+
+class RegionSelector:
+    """Let the user drag a rectangle over the scene, and pass it on in scene coordinates."""
+
+    def __init__(self, scene: QGraphicsScene):
+        self.scene = scene
+        self.callback: Optional[Callable[[QRectF], None]] = None
+        self.start_point: Optional[QPointF] = None
+        self.rect_item: Optional[QGraphicsRectItem] = None
+
+    def wait_for(self, callback: Callable[[QRectF], None]):
+        self.cancel()
+        self.callback = callback
+
+    def cancel(self):
+        if self.rect_item is not None:
+            self.scene.removeItem(self.rect_item)
+            self.rect_item = None
+        self.start_point = None
+        self.callback = None
+
+    def mouse_press_event(self, event: QMouseEvent) -> bool:
+        if self.callback is not None:
+            self.start_point = QPointF(event.pos())
+            return True
+        return False
+
+    def mouse_move_event(self, event: QMouseEvent) -> bool:
+        if self.callback is None:
+            return False
+        if self.start_point is not None:
+            if self.rect_item is None:
+                self.rect_item = QGraphicsRectItem()
+                pen = QPen(QColor("white"))
+                pen.setWidth(2)
+                pen.setStyle(Qt.PenStyle.DashLine)
+                self.rect_item.setPen(pen)
+                self.rect_item.setZValue(1)
+                self.scene.addItem(self.rect_item)
+            self.rect_item.setRect(self._rect(event))
+        return True
+
+    def mouse_release_event(self, event: QMouseEvent) -> bool:
+        if self.callback is None:
+            return False
+        if self.start_point is not None:
+            callback = self.callback
+            rect = self._rect(event)
+            self.cancel()
+            callback(rect)
+        return True
+
+    def _rect(self, event: QMouseEvent) -> QRectF:
+        assert self.start_point is not None
+        return QRectF(self.start_point, QPointF(event.pos())).normalized()
@@ -0,0 +1,126 @@
+import dataclasses
+import hashlib
+import json
+import os.path
+import shutil
+from typing import Callable, Optional, Union
+
+import numpy as np
+import platformdirs
+
+from battle_map_tv.scale_detection import (
+    ScaleDetectionResult,
+    SearchHint,
+    detect_array_scale,
+    detect_image_scale,
+    detector_version,
+)
+from battle_map_tv.workers import ProgressCallback
+
+path = os.path.join(platformdirs.user_cache_dir("battle-map-tv"), "scale_detection")
+max_entries = 1000
+
+
+def image_hash(image_path: str) -> str:
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(image_path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _version_path() -> str:
+    return os.path.join(path, f"v{detector_version}")
+
+
+def _entry_path(key: str) -> str:
+    return os.path.join(_version_path(), f"{key}.json")
+
+
+def cache_key(image_path: str, pyramid: bool, engine: str) -> str:
+    return f"{image_hash(image_path)}-{engine}{'-pyramid' if pyramid else ''}"
+
+
+def get_from_cache(key: str) -> Optional[ScaleDetectionResult]:
+    filepath = _entry_path(key)
+    try:
+        with open(filepath) as f:
+            data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    # mark as recently used
+    os.utime(filepath)
+    return ScaleDetectionResult(**data)
+
+
+def set_in_cache(key: str, result: ScaleDetectionResult):
+    os.makedirs(_version_path(), exist_ok=True)
+    data = dataclasses.asdict(result)
+    # the metrics are about this run of the detection only
+    del data["metrics"]
+    # catch errors before start writing to the file
+    json_str = json.dumps(data)
+    with open(_entry_path(key), "w") as f:
+        f.write(json_str)
+    evict()
+
+
+def evict():
+    """Remove results of other detector versions and the least recently used results."""
+    if not os.path.isdir(path):
+        return
+    for dirname in os.listdir(path):
+        if dirname != f"v{detector_version}":
+            shutil.rmtree(os.path.join(path, dirname), ignore_errors=True)
+    with os.scandir(_version_path()) as it:
+        entries = sorted(it, key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in entries[max_entries:]:
+        os.remove(entry.path)
+
+
+def detect_image_scale_cached(
+    image_path: str,
+    pyramid: bool = False,
+    engine: str = "hough",
+    progress: Optional[ProgressCallback] = None,
+    time_budget: Optional[float] = None,
+    image: Union[np.ndarray, Callable[[], np.ndarray], None] = None,
+    hint: Optional[SearchHint] = None,
+) -> ScaleDetectionResult:
+    """Detect the scale of an image file, or get it from the cache.
+
+    Pass the pixels of the file as `image` if they're already decoded, so they aren't decoded
+    again. The file is still read to find the cached result. `image` can also be a function that
+    returns the pixels, which is only called when the result isn't cached.
+
+    Only complete results that found a grid are cached.
+    """
+    key = cache_key(image_path, pyramid=pyramid, engine=engine)
+    result = get_from_cache(key)
+    if result is not None:
+        return result
+    if callable(image):
+        image = image()
+    if image is not None:
+        result = detect_array_scale(
+            image,
+            pyramid=pyramid,
+            engine=engine,
+            progress=progress,
+            time_budget=time_budget,
+            hint=hint,
+        )
+    else:
+        result = detect_image_scale(
+            image_path,
+            pyramid=pyramid,
+            engine=engine,
+            progress=progress,
+            time_budget=time_budget,
+            hint=hint,
+        )
+    # a result that ran out of time can still improve, and when no grid was found, detecting
+    # again with another search hint can still find it
+    if result.complete and result.grid_found:
+        set_in_cache(key, result)
+    return result
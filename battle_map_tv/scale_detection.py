@@ -1,39 +1,286 @@
-from typing import Tuple, List, Optional
+import contextlib
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, Tuple, List, Optional
 
 import cv2
 import numpy as np
+from PySide6.QtCore import QRect
+from PySide6.QtGui import QImage, QImageIOHandler, QImageReader
 
+from battle_map_tv.utils import qimage_to_array
+from battle_map_tv.workers import ProgressCallback
 
-def find_image_scale(image_path: str, show_result: bool = False) -> float:
-    image = cv2.imread(image_path)
-    height, width, _ = image.shape
+logger = logging.getLogger(__name__)
 
-    edges = image_to_edges(image)
+# increase when a change to the detection can give different results
+detector_version = 4
 
-    theta_horizontal = np.pi / 2
-    theta_vertical = 0
+theta_step = np.pi / 180
 
-    print("--- horizontal ---")
-    px_per_inch_horizontal, confidence_horizontal, lines_horizontal = optimization(
-        edges=edges,
-        wanted_theta=theta_horizontal,
-        image_length=width,
+theta_horizontal = np.pi / 2
+theta_vertical = 0
+
+# longest side of the downsampled image used in pyramid mode
+pyramid_coarse_size = 1024
+
+engines = ("hough", "projection", "auto")
+# in auto mode, below this confidence the projection result is checked with the Hough engine
+projection_min_confidence = 0.5
+# below this confidence the edges aren't periodic, so the image has no grid
+periodic_min_confidence = 0.2
+# in pixels, of the blur of the edges summed along an axis
+profile_blur = 1.0
+# weight of the autocorrelation at half the spacing that's subtracted from the confidence
+half_spacing_penalty = 2.0
+
+# maximum number of threshold steps per axis in the Hough engine
+max_steps = 50
+# range of the number of grid lines that gives a reasonable result
+min_lines = 9
+max_lines = 100
+# the threshold search first tries numbers of lines that are at most this factor apart
+coarse_ratio = 2.0
+# and stops when the most promising interval is this narrow
+converged_ratio = 1.2
+# a result of the thresholds from the search hint with this confidence makes a full search unneeded
+hint_min_confidence = 0.7
+# below this length of the mean of the line positions as unit vectors, they have no clear phase
+phase_min_consistency = 0.5
+
+# memory used by a detection on the whole image, for the color image, its grey copy and the edges
+detection_bytes_per_pixel = 5
+# memory used for a tile, decoded as 32-bit color, its grey copy and the edges
+tile_bytes_per_pixel = 6
+# side of the tiles in tile sampling mode, enough for ten squares of 200 pixels
+tile_size = 2048
+max_tiles = 9
+# tiles are merged if their spacing is within this fraction of the median of all tiles
+tile_agreement = 0.02
+
+AxisResult = Tuple[float, float, List[float]]
+
+# the axes are detected in parallel threads that share the metrics
+_metrics_lock = threading.Lock()
+
+
+@dataclass
+class StageTime:
+    calls: int = 0
+    seconds: float = 0.0
+
+
+@dataclass
+class DetectionMetrics:
+    """Time spent in the stages of a detection, and counts of what it found.
+
+    The stages of the two axes run in parallel threads, so the stage times can add up to more
+    than the total time.
+    """
+
+    total_seconds: float = 0.0
+    stages: Dict[str, StageTime] = field(default_factory=dict)
+    counters: Dict[str, int] = field(default_factory=dict)
+    # vote thresholds of the lines that were found, divided by the length of the lines
+    line_coverage: List[float] = field(default_factory=list)
+    start: float = field(default_factory=time.perf_counter, repr=False)
+
+    @contextlib.contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with _metrics_lock:
+                stage_time = self.stages.setdefault(stage, StageTime())
+                stage_time.calls += 1
+                stage_time.seconds += seconds
+
+    def count(self, counter: str, n: int = 1):
+        with _metrics_lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def stop(self):
+        self.total_seconds = time.perf_counter() - self.start
+
+    def summary(self) -> str:
+        stages = ", ".join(
+            f"{stage} {stage_time.seconds:.3f}s ({stage_time.calls}x)"
+            for stage, stage_time in self.stages.items()
+        )
+        counters = ", ".join(f"{counter} {n}" for counter, n in self.counters.items())
+        return f"{self.total_seconds:.3f}s total, {stages}, {counters}"
+
+
+@dataclass
+class SearchHint:
+    """Vote thresholds to search first, divided by the length of the lines.
+
+    That's about the fraction of a grid line that's found as edges, which is similar for maps of
+    the same style. See `DetectionMetrics.line_coverage`.
+    """
+
+    coverage: float
+    low: float
+    high: float
+
+
+@dataclass
+class ScaleDetectionResult:
+    px_per_inch: float
+    confidence: float
+    rhos_horizontal: List[float]
+    rhos_vertical: List[float]
+    # false when the time budget ran out before the detection was done
+    complete: bool = True
+    # position in pixels of the first vertical and horizontal grid line, if lines were found
+    phase_x: Optional[float] = None
+    phase_y: Optional[float] = None
+    # not set on results from the cache
+    metrics: Optional[DetectionMetrics] = field(default=None, compare=False)
+
+    @property
+    def grid_found(self) -> bool:
+        return self.confidence > 0
+
+
+def find_image_scale(
+    image_path: str,
+    show_result: bool = False,
+    pyramid: bool = False,
+    engine: str = "hough",
+) -> float:
+    result = detect_image_scale(
+        image_path=image_path,
+        show_result=show_result,
+        pyramid=pyramid,
+        engine=engine,
     )
-    print()
-    print("--- vertical ---")
-    px_per_inch_vertical, confidence_vertical, lines_vertical = optimization(
-        edges=edges,
-        wanted_theta=theta_vertical,
-        image_length=height,
+    return result.px_per_inch
+
+
+def detect_image_scale(
+    image_path: str,
+    show_result: bool = False,
+    pyramid: bool = False,
+    engine: str = "hough",
+    progress: Optional[ProgressCallback] = None,
+    time_budget: Optional[float] = None,
+    memory_cap: Optional[int] = None,
+    hint: Optional[SearchHint] = None,
+) -> ScaleDetectionResult:
+    """Detect the grid on an image file.
+
+    With a `time_budget` in seconds, the Hough engine returns its best result so far when the
+    time is up. The image decoding and the Hough transform itself can't be interrupted.
+
+    With a `memory_cap` in bytes that's too small for the whole image, the grid is detected on a
+    sample of tiles instead, see `detect_image_scale_tiled`.
+    """
+    start = time.monotonic()
+    if engine not in engines:
+        raise ValueError(f"Unknown scale detection engine {engine}, choose from {engines}")
+    if memory_cap is not None:
+        width, height = image_size(image_path)
+        if width * height * detection_bytes_per_pixel > memory_cap:
+            return detect_image_scale_tiled(
+                image_path=image_path,
+                memory_cap=memory_cap,
+                pyramid=pyramid,
+                engine=engine,
+                progress=progress,
+                time_budget=time_budget,
+                hint=hint,
+            )
+    metrics = DetectionMetrics()
+    with metrics.timer("decode"):
+        image = cv2.imread(image_path)
+    if image is None:
+        raise ValueError(f"Could not read image {image_path}")
+    if time_budget is not None:
+        time_budget -= time.monotonic() - start
+    return detect_array_scale(
+        image=image,
+        show_result=show_result,
+        pyramid=pyramid,
+        engine=engine,
+        progress=progress,
+        time_budget=time_budget,
+        metrics=metrics,
+        hint=hint,
     )
 
-    print()
-    print(
-        f"horizontal: {int(px_per_inch_horizontal)} px/inch (confidence {confidence_horizontal}, "
-        f"vertical: {int(px_per_inch_vertical)} px/inch (confidence {confidence_vertical}"
+
+def detect_array_scale(
+    image: np.ndarray,
+    show_result: bool = False,
+    pyramid: bool = False,
+    engine: str = "hough",
+    progress: Optional[ProgressCallback] = None,
+    time_budget: Optional[float] = None,
+    metrics: Optional[DetectionMetrics] = None,
+    hint: Optional[SearchHint] = None,
+) -> ScaleDetectionResult:
+    """Detect the grid on an image that's already decoded.
+
+    The image can be BGR, BGRA or grey, like OpenCV uses. It's only read, so it can be a view on
+    pixels that are shown elsewhere, see `utils.qimage_to_array`.
+
+    The timings and counts of the detection are added to `metrics` if given, and the result
+    holds them in any case.
+    """
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+    if engine not in engines:
+        raise ValueError(f"Unknown scale detection engine {engine}, choose from {engines}")
+    if metrics is None:
+        metrics = DetectionMetrics()
+    height, width = image.shape[:2]
+
+    if engine == "hough":
+        horizontal, vertical = hough_detection(
+            image=image,
+            pyramid=pyramid,
+            progress=progress,
+            deadline=deadline,
+            metrics=metrics,
+            hint=hint,
+        )
+    else:
+        projection_progress = progress if engine == "projection" else _part(progress, 0.0, 0.5)
+        horizontal, vertical = projection_detection(
+            image=image, progress=projection_progress, metrics=metrics
+        )
+        if engine == "auto" and max(horizontal[1], vertical[1]) < projection_min_confidence:
+            logger.debug("projection result not confident, using Hough lines")
+            horizontal_hough, vertical_hough = hough_detection(
+                image=image,
+                pyramid=pyramid,
+                progress=_part(progress, 0.5, 1.0),
+                deadline=deadline,
+                metrics=metrics,
+                hint=hint,
+            )
+            horizontal = max(horizontal, horizontal_hough, key=lambda x: x[1])
+            vertical = max(vertical, vertical_hough, key=lambda x: x[1])
+    px_per_inch_horizontal, confidence_horizontal, lines_horizontal = horizontal
+    px_per_inch_vertical, confidence_vertical, lines_vertical = vertical
+
+    logger.info(
+        "horizontal: %.1f px/inch (confidence %.2f), vertical: %.1f px/inch (confidence %.2f)",
+        px_per_inch_horizontal,
+        confidence_horizontal,
+        px_per_inch_vertical,
+        confidence_vertical,
     )
 
     if show_result:
+        # don't draw on pixels that may be shown elsewhere
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) if image.ndim == 2 else image.copy()
         add_lines_to_image(
             image=image, rhos=lines_horizontal, wanted_theta=theta_horizontal, image_length=width
         )
@@ -44,107 +291,680 @@ def find_image_scale(image_path: str, show_result: bool = False) -> float:
         cv2.waitKey(0)
         cv2.destroyAllWindows()
 
-    return (
-        px_per_inch_horizontal
-        if confidence_horizontal > confidence_vertical
-        else px_per_inch_vertical
+    if confidence_horizontal > confidence_vertical:
+        px_per_inch, confidence = px_per_inch_horizontal, confidence_horizontal
+    else:
+        px_per_inch, confidence = px_per_inch_vertical, confidence_vertical
+    metrics.stop()
+    logger.info("detection metrics: %s", metrics.summary())
+    return ScaleDetectionResult(
+        px_per_inch=px_per_inch,
+        confidence=confidence,
+        rhos_horizontal=lines_horizontal,
+        rhos_vertical=lines_vertical,
+        complete=deadline is None or time.monotonic() < deadline,
+        phase_x=grid_phase(rhos=lines_vertical, px_per_inch=px_per_inch),
+        phase_y=grid_phase(rhos=lines_horizontal, px_per_inch=px_per_inch),
+        metrics=metrics,
     )
 
 
-def optimization(edges, wanted_theta: float, image_length: int) -> Tuple[float, float, List[float]]:
-    hough_lines_threshold = 1500
-    i = 0
-    n_hits = 0
-    results: List[Tuple[Optional[float], float, List[float]]] = []
+def image_size(image_path: str) -> Tuple[int, int]:
+    """Width and height of an image file, without decoding it."""
+    size = QImageReader(image_path).size()
+    if not size.isValid():
+        raise ValueError(f"Could not read image {image_path}")
+    return size.width(), size.height()
 
-    def do_step(_i, _threshold):
-        _i += 1
-        results.append(
-            px_per_inch_detection(
-                edges=edges,
-                hough_lines_threshold=_threshold,
-                wanted_theta=wanted_theta,
-                image_length=image_length,
-            )
+
+def detect_image_scale_tiled(
+    image_path: str,
+    memory_cap: int,
+    pyramid: bool = False,
+    engine: str = "hough",
+    progress: Optional[ProgressCallback] = None,
+    time_budget: Optional[float] = None,
+    hint: Optional[SearchHint] = None,
+) -> ScaleDetectionResult:
+    """Detect the grid on tiles spread over an image file, using about `memory_cap` bytes.
+
+    Formats that can be decoded in part, like JPEG, only have the tiles decoded. Other formats
+    are decoded as a whole in grey, which takes one byte per pixel. If that doesn't fit either,
+    the image is decoded at half, a quarter or an eighth of its size, which can miss thin lines.
+    The results of the tiles that agree with each other are merged.
+    """
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+    metrics = DetectionMetrics()
+    width, height = image_size(image_path)
+    size = min(tile_size, int(np.sqrt(memory_cap / tile_bytes_per_pixel)), width, height)
+
+    grey: Optional[np.ndarray] = None
+    factor = 1
+    if not QImageReader(image_path).supportsOption(QImageIOHandler.ImageOption.ClipRect):
+        while factor < 8 and (width * height) / factor**2 + 2 * size**2 > memory_cap:
+            factor *= 2
+        flags = {
+            1: cv2.IMREAD_GRAYSCALE,
+            2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+            4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+            8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+        }
+        with metrics.timer("decode"):
+            grey = cv2.imread(image_path, flags[factor])
+        if grey is None:
+            raise ValueError(f"Could not read image {image_path}")
+        size = min(size, *grey.shape)
+
+    def read_tile(x: int, y: int) -> np.ndarray:
+        if grey is not None:
+            return grey[y : y + size, x : x + size]
+        reader = QImageReader(image_path)
+        reader.setClipRect(QRect(x, y, size, size))
+        qimage = reader.read()
+        if qimage.isNull():
+            raise ValueError(f"Could not read image {image_path}: {reader.errorString()}")
+        qimage = qimage.convertToFormat(QImage.Format.Format_Grayscale8)
+        # copy the pixels, the QImage is freed when this function returns
+        return np.array(qimage_to_array(qimage))
+
+    positions = tile_positions(
+        width=width if grey is None else grey.shape[1],
+        height=height if grey is None else grey.shape[0],
+        size=size,
+        n=max_tiles,
+    )
+    tile_results: List[Tuple[int, int, ScaleDetectionResult]] = []
+    for i, (x, y) in enumerate(positions):
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+        with metrics.timer("decode"):
+            tile = read_tile(x, y)
+        result = detect_array_scale(
+            tile,
+            pyramid=pyramid,
+            engine=engine,
+            progress=_part(progress, i / len(positions), (i + 1) / len(positions)),
+            time_budget=None if deadline is None else deadline - time.monotonic(),
+            metrics=metrics,
+            hint=hint,
         )
-        print(
-            f"Step {i}: {len(results[-1][2])} lines, threshold {_threshold}, confidence {results[-1][1]}"
+        metrics.count("tiles")
+        logger.debug("tile at %d, %d: %.1f px/inch", x, y, result.px_per_inch)
+        tile_results.append((x, y, result))
+        del tile
+
+    result = merge_tile_results(tile_results, n_tiles=len(positions), factor=factor)
+    result.complete = len(tile_results) == len(positions) and all(
+        tile_result.complete for _, _, tile_result in tile_results
+    )
+    metrics.stop()
+    result.metrics = metrics
+    logger.info(
+        "%d tiles: %.1f px/inch (confidence %.2f)",
+        len(tile_results),
+        result.px_per_inch,
+        result.confidence,
+    )
+    return result
+
+
+def tile_positions(width: int, height: int, size: int, n: int) -> List[Tuple[int, int]]:
+    """Top left corners of at most `n` tiles spread evenly over an image."""
+    per_side = int(np.ceil(np.sqrt(n)))
+    xs = np.unique(np.linspace(0, width - size, per_side).round().astype(int))
+    ys = np.unique(np.linspace(0, height - size, per_side).round().astype(int))
+    positions = [(int(x), int(y)) for y in ys for x in xs]
+    if len(positions) <= n:
+        return positions
+    # spread the tiles that fit over the grid of positions
+    indices = np.linspace(0, len(positions) - 1, n).round().astype(int)
+    return [positions[i] for i in indices]
+
+
+def merge_tile_results(
+    tile_results: List[Tuple[int, int, ScaleDetectionResult]],
+    n_tiles: int,
+    factor: int = 1,
+) -> ScaleDetectionResult:
+    """Combine the results of tiles at the given positions into one for the whole image.
+
+    Tiles with a spacing close to the median of all tiles with a grid are averaged, weighted by
+    their confidence. The confidence is that of the tiles that agree, spread over all tiles.
+    Positions and spacing are multiplied by `factor` for an image that was decoded smaller.
+    """
+    found = [(x, y, result) for x, y, result in tile_results if result.grid_found]
+    if not found:
+        return ScaleDetectionResult(
+            px_per_inch=10.0, confidence=0.0, rhos_horizontal=[], rhos_vertical=[]
         )
-        return _i
-
-    while True:
-        i = do_step(i, hough_lines_threshold)
-        confidence = results[-1][1]
-        n_lines = len(results[-1][2])
-        if n_lines == 0:
-            hough_lines_threshold -= 200
-        else:
-            n_hits += 1
-            if n_hits == 1 and i > 1:
-                i = do_step(i, hough_lines_threshold + 100)
-                i = do_step(i, hough_lines_threshold + 50)
-                i = do_step(i, hough_lines_threshold + 25)
-            if n_hits < 5:
-                hough_lines_threshold -= 25
-            else:
-                hough_lines_threshold -= 100
-
-        last_confidences = [result[1] for result in results[-5:]]
-        last_confidences_equal = np.all(
-            np.abs(np.median(last_confidences) - last_confidences) < 0.01  # type: ignore
+    median = float(np.median([result.px_per_inch for _, _, result in found]))
+    agreeing = [
+        (x, y, result)
+        for x, y, result in found
+        if abs(result.px_per_inch - median) <= tile_agreement * median
+    ]
+    confidences = np.array([result.confidence for _, _, result in agreeing])
+    spacings = np.array([result.px_per_inch for _, _, result in agreeing])
+    px_per_inch = float(np.sum(confidences * spacings) / np.sum(confidences)) * factor
+    # overlapping tiles give the same lines twice, which doesn't change their spacing or phase
+    rhos_horizontal = sorted(
+        (y + rho) * factor for _, y, result in agreeing for rho in result.rhos_horizontal
+    )
+    rhos_vertical = sorted(
+        (x + rho) * factor for x, _, result in agreeing for rho in result.rhos_vertical
+    )
+    return ScaleDetectionResult(
+        px_per_inch=px_per_inch,
+        confidence=float(np.sum(confidences)) / n_tiles,
+        rhos_horizontal=rhos_horizontal,
+        rhos_vertical=rhos_vertical,
+        phase_x=grid_phase(rhos=rhos_vertical, px_per_inch=px_per_inch),
+        phase_y=grid_phase(rhos=rhos_horizontal, px_per_inch=px_per_inch),
+    )
+
+
+def _part(progress: Optional[ProgressCallback], start: float, stop: float):
+    """Map the progress of one part of the work to the progress of the whole."""
+    if progress is None:
+        return None
+    return lambda fraction: progress(start + fraction * (stop - start))
+
+
+def _parallel_parts(progress: Optional[ProgressCallback], n: int):
+    """Split progress over parts of the work that run at the same time."""
+    if progress is None:
+        return [None] * n
+    fractions = [0.0] * n
+    lock = threading.Lock()
+
+    def get_callback(i: int) -> ProgressCallback:
+        def callback(fraction: float):
+            with lock:
+                fractions[i] = fraction
+                total = sum(fractions) / n
+            progress(total)
+
+        return callback
+
+    return [get_callback(i) for i in range(n)]
+
+
+def hough_detection(
+    image,
+    pyramid: bool,
+    progress: Optional[ProgressCallback] = None,
+    deadline: Optional[float] = None,
+    metrics: Optional[DetectionMetrics] = None,
+    hint: Optional[SearchHint] = None,
+) -> Tuple[AxisResult, AxisResult]:
+    if progress is not None:
+        progress(0.0)
+    if metrics is None:
+        metrics = DetectionMetrics()
+    height, width = image.shape[:2]
+
+    # in pyramid mode, find the lines on a downsampled image and refine them at full resolution
+    factor = max(max(width, height) / pyramid_coarse_size, 1.0) if pyramid else 1.0
+    detection_image = image
+    if factor > 1:
+        with metrics.timer("downsample"):
+            # the edges are found in grey, so erode and refine on grey pixels, converted once
+            image = to_grey(image)
+            detection_image = downsample(image, factor=factor)
+    detection_height, detection_width = detection_image.shape[:2]
+
+    with metrics.timer("canny"):
+        upper_threshold = canny_upper_threshold(detection_image)
+        edges = image_to_edges(detection_image, upper_threshold=upper_threshold)
+
+    # the projection is cheap compared to the Hough transform, skip that without a grid
+    with metrics.timer("periodicity"):
+        periodic = is_periodic(edges)
+    if not periodic:
+        logger.info("edges are not periodic, no grid found")
+        if progress is not None:
+            progress(1.0)
+        return (10.0, 0.0, []), (10.0, 0.0, [])
+
+    def detect_axis(
+        wanted_theta: float,
+        image_length: int,
+        axis_factor: float,
+        axis_progress: Optional[ProgressCallback],
+    ) -> AxisResult:
+        with metrics.timer("hough_transform"):
+            accumulator = HoughAccumulator(edges, wanted_theta=wanted_theta)
+        result = optimization(
+            accumulator=accumulator,
+            wanted_theta=wanted_theta,
+            image_length=image_length,
+            progress=axis_progress,
+            deadline=deadline,
+            metrics=metrics,
+            hint=hint,
         )
-        if len(results) > 5 and confidence > 0 and last_confidences_equal:
-            break
-        if n_lines > 100 or i > 50:
-            break
-        if hough_lines_threshold <= 0:
+        if factor > 1:
+            with metrics.timer("refine"):
+                result = refine_detection(
+                    image=image,
+                    rhos=result[2],
+                    wanted_theta=wanted_theta,
+                    factor=axis_factor,
+                    upper_threshold=upper_threshold,
+                )
+        return result
+
+    # OpenCV releases the GIL, so both orientations can be detected at the same time
+    progress_horizontal, progress_vertical = _parallel_parts(progress, 2)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        future_horizontal = executor.submit(
+            detect_axis,
+            wanted_theta=theta_horizontal,
+            image_length=detection_width,
+            axis_factor=height / detection_height,
+            axis_progress=progress_horizontal,
+        )
+        future_vertical = executor.submit(
+            detect_axis,
+            wanted_theta=theta_vertical,
+            image_length=detection_height,
+            axis_factor=width / detection_width,
+            axis_progress=progress_vertical,
+        )
+        return future_horizontal.result(), future_vertical.result()
+
+
+def projection_detection(
+    image,
+    progress: Optional[ProgressCallback] = None,
+    metrics: Optional[DetectionMetrics] = None,
+) -> Tuple[AxisResult, AxisResult]:
+    if progress is not None:
+        progress(0.0)
+    if metrics is None:
+        metrics = DetectionMetrics()
+    with metrics.timer("canny"):
+        edges = image_to_edges(image)
+    with metrics.timer("projection"):
+        horizontal = px_per_inch_projection(edges=edges, axis=0)
+        vertical = px_per_inch_projection(edges=edges, axis=1)
+    logger.debug("projection: horizontal %s, vertical %s", horizontal, vertical)
+    if progress is not None:
+        progress(1.0)
+    # this engine doesn't locate individual lines
+    return (*horizontal, []), (*vertical, [])
+
+
+def is_periodic(edges) -> bool:
+    return any(px_per_inch_projection(edges=edges, axis=axis)[1] > 0 for axis in (0, 1))
+
+
+def px_per_inch_projection(edges, axis: int) -> Tuple[float, float]:
+    """Find the grid spacing from the autocorrelation of the edges summed along one axis.
+
+    Axis 0 gives the spacing of the horizontal lines, axis 1 of the vertical lines. Without a
+    clear period, the confidence is zero.
+    """
+    profile = edges.sum(axis=1 - axis, dtype=np.float64)
+    length = len(profile)
+    # same range of reasonable results as for the Hough lines
+    min_lag = max(length // 120, 2)
+    max_lag = length // 8
+    if max_lag <= min_lag:
+        return 10.0, 0.0
+
+    # remove slow changes in the amount of edges, keep the narrow peaks of the lines
+    window = 4 * min_lag + 1
+    background = cv2.blur(profile.reshape(-1, 1), (1, window), borderType=cv2.BORDER_REFLECT)
+    profile = profile - background.ravel()
+    # when the spacing isn't a whole number of pixels, the lines are alternately a pixel closer
+    # and further apart, which splits the peak of the spacing over two lags; blur them together
+    profile = cv2.GaussianBlur(
+        profile.reshape(-1, 1), (1, 0), sigmaX=0, sigmaY=profile_blur
+    ).ravel()
+
+    # autocorrelation through the FFT, zero padded to avoid wrapping around
+    spectrum = np.fft.rfft(profile, n=2 * length)
+    autocorrelation = np.fft.irfft(spectrum * np.conj(spectrum), n=2 * length)[:length]
+    autocorrelation /= length - np.arange(length)
+    if autocorrelation[0] <= 0:
+        return 10.0, 0.0
+    autocorrelation /= autocorrelation[0]
+
+    candidates = autocorrelation[min_lag - 1 : max_lag + 2]
+    is_peak = (candidates[1:-1] > candidates[:-2]) & (candidates[1:-1] >= candidates[2:])
+    peaks = np.flatnonzero(is_peak) + min_lag
+    if len(peaks) == 0:
+        return 10.0, 0.0
+    # multiples of the grid spacing give peaks as well, take the first strong one
+    strong_peaks = peaks[autocorrelation[peaks] >= 0.6 * autocorrelation[peaks].max()]
+    lag = int(strong_peaks[0])
+    confidence = float(autocorrelation[lag])
+    if confidence < periodic_min_confidence:
+        return 10.0, 0.0
+
+    # the peaks at multiples of the spacing give a more precise value
+    px_per_inch = float(lag)
+    for multiple in range(2, 50):
+        lag_multiple = int(round(px_per_inch * multiple))
+        if lag_multiple + 3 >= length // 2:
             break
-        if n_lines > 20 and confidence > 0.9:
+        i = lag_multiple - 2 + int(np.argmax(autocorrelation[lag_multiple - 2 : lag_multiple + 3]))
+        if autocorrelation[i] < 0.5 * confidence:
             break
+        px_per_inch = (i + _parabola_vertex(*autocorrelation[i - 1 : i + 2])) / multiple
+
+    # a peak at half the spacing as well means that every other line may be missed, then the
+    # result isn't to be trusted, but the edges are still periodic
+    half_lag = max(int(round(px_per_inch / 2)), 2)
+    half_peak = float(autocorrelation[half_lag - 1 : half_lag + 2].max())
+    if half_peak > 0:
+        confidence = max(confidence - half_spacing_penalty * half_peak, periodic_min_confidence)
+    return px_per_inch, confidence
+
+
+def _parabola_vertex(a: float, b: float, c: float) -> float:
+    # offset of the top of a parabola through three equally spaced points, relative to the middle
+    curvature = a - 2 * b + c
+    if curvature >= 0:
+        return 0.0
+    return float(np.clip(0.5 * (a - c) / curvature, -0.5, 0.5))
+
+
+def optimization(
+    accumulator: "HoughAccumulator",
+    wanted_theta: float,
+    image_length: int,
+    progress: Optional[ProgressCallback] = None,
+    deadline: Optional[float] = None,
+    metrics: Optional[DetectionMetrics] = None,
+    hint: Optional[SearchHint] = None,
+) -> Tuple[float, float, List[float]]:
+    """Search the Hough vote threshold that gives the most regular grid lines.
+
+    With the votes of the n-th strongest line as threshold there are about n lines, so the search
+    runs over n. It first brackets the numbers of lines that can give a reasonable result, then
+    bisects that range into a coarse scan and after that repeatedly bisects the interval with the
+    most confident ends. Most peaks in the accumulator are weak, so intervals are split at the
+    geometric mean.
+
+    With a `hint`, the thresholds that worked on earlier images are searched first. The full search
+    only runs when none of them gives a confident result.
+
+    The search stops after `max_steps` thresholds or at the `deadline`, a `time.monotonic` value,
+    and returns the best result so far.
+    """
+    orientation = "horizontal" if wanted_theta else "vertical"
+    if metrics is None:
+        metrics = DetectionMetrics()
+    votes = accumulator.votes(wanted_theta=wanted_theta)
+    if not votes:
+        return 10.0, 0.0, []
+    results: Dict[int, Tuple[Optional[float], float, List[float]]] = {}
+
+    def do_step(n: int) -> Tuple[Optional[float], float, List[float]]:
+        # lines with equal votes give the same threshold
+        threshold = votes[n]
+        if threshold not in results:
+            results[threshold] = px_per_inch_detection(
+                accumulator=accumulator,
+                hough_lines_threshold=threshold,
+                wanted_theta=wanted_theta,
+                image_length=image_length,
+                metrics=metrics,
+            )
+            metrics.count(f"{orientation}_threshold_steps")
+            logger.debug(
+                "%s step %d: %d lines, threshold %d, confidence %.3f",
+                orientation,
+                len(results),
+                len(results[threshold][2]),
+                threshold,
+                results[threshold][1],
+            )
+            if progress is not None:
+                progress(min(len(results) / max_steps, 1.0))
+        return results[threshold]
+
+    def stop() -> bool:
+        if len(results) >= max_steps:
+            return True
+        if deadline is not None and time.monotonic() >= deadline:
+            return True
+        return any(len(rhos) > 20 and confidence > 0.9 for _, confidence, rhos in results.values())
+
+    def split(start: int, end: int) -> int:
+        middle = int(round(np.sqrt(start * end)))
+        return min(max(middle, start + 1), end - 1)
+
+    # the confidence can peak at a narrow range of thresholds, so first bisect all intervals to a
+    # coarse scan, then bisect the most promising interval first
+    def search(bounds: List[int]):
+        intervals: List[Tuple[bool, float, float, int, int]] = []
+
+        def add_interval(start: int, end: int):
+            if end - start > 1:
+                confidence = max(confidences.get(start, 0.0), confidences.get(end, 0.0))
+                is_fine = end / start <= coarse_ratio
+                heapq.heappush(intervals, (is_fine, -confidence, start / end, start, end))
 
-    best_result = max(results, key=lambda x: x[1])
-    px_per_inch, confidence, rhos = best_result
-    print(f"px per inch {px_per_inch}, {len(rhos)} lines, confidence {confidence}")
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            add_interval(start, end)
+        while intervals and not stop():
+            is_fine, _, _, start, end = heapq.heappop(intervals)
+            if is_fine and end / start <= converged_ratio:
+                # the most promising interval is narrow enough
+                break
+            middle = split(start, end)
+            confidences[middle] = do_step(middle)[1]
+            add_interval(start, middle)
+            add_interval(middle, end)
+
+    # fewer lines than this never give a reasonable result
+    first = min(min_lines, len(votes) - 1)
+    last = len(votes) - 1
+    confidences: Dict[int, float] = {}
+
+    if hint is not None and first > 0:
+        # search the thresholds that worked on earlier images first
+        def number_of_lines(coverage: float) -> int:
+            n = sum(v > coverage * image_length for v in votes)
+            return min(max(n, first), last)
+
+        seed = number_of_lines(hint.coverage)
+        bounds = sorted({number_of_lines(hint.high), seed, number_of_lines(hint.low)})
+        confidences[seed] = do_step(seed)[1]
+        for n in bounds:
+            if not stop():
+                confidences[n] = do_step(n)[1]
+        if max(confidences.values()) >= hint_min_confidence:
+            search(bounds)
+
+    if not confidences or max(confidences.values()) < hint_min_confidence:
+        confidences[first] = do_step(first)[1]
+        # find the smallest number of lines that gives too many lines after merging
+        if not stop():
+            rhos = do_step(last)[2]
+            confidences[last] = do_step(last)[1]
+            if len(rhos) >= max_lines:
+                low = first
+                while last - low > 1 and not stop():
+                    middle = split(low, last)
+                    _, confidences[middle], rhos = do_step(middle)
+                    if len(rhos) >= max_lines:
+                        last = middle
+                    else:
+                        low = middle
+        search([first, last])
+
+    # prefer fewer, stronger lines when the confidence is the same
+    best_threshold = max(sorted(results, reverse=True), key=lambda t: results[t][1])
+    px_per_inch, confidence, rhos = results[best_threshold]
+    metrics.count(f"{orientation}_lines", len(rhos))
+    if confidence > 0:
+        with _metrics_lock:
+            metrics.line_coverage.append(best_threshold / image_length)
+    logger.debug(
+        "%s px per inch %s, %d lines, confidence %.3f",
+        orientation,
+        px_per_inch,
+        len(rhos),
+        confidence,
+    )
+    if progress is not None:
+        progress(1.0)
     return px_per_inch or 10.0, confidence, rhos
 
 
 def px_per_inch_detection(
-    edges,
+    accumulator: "HoughAccumulator",
     hough_lines_threshold: int,
     wanted_theta: float,
     image_length: int,
+    metrics: Optional[DetectionMetrics] = None,
 ) -> Tuple[Optional[float], float, List[float]]:
-    lines = edges_to_lines(edges, threshold=hough_lines_threshold)
+    if metrics is None:
+        metrics = DetectionMetrics()
+    with metrics.timer("hough_lines"):
+        lines = accumulator.lines(threshold=hough_lines_threshold)
 
     rhos = keep_only_lines_with_certain_orientation(lines=lines, wanted_theta=wanted_theta)
 
     if not rhos:
         return None, 0.0, []
 
-    rhos = merge_close_together_lines(lines=rhos, threshold_px=image_length / 250)
+    with metrics.timer("merge_lines"):
+        rhos = merge_close_together_lines(lines=rhos, threshold_px=image_length / 250)
 
     if len(rhos) <= 1:
         return None, 0.0, []
 
+    avg, confidence = lines_spacing(rhos=rhos, image_length=image_length)
+    return avg, confidence, rhos
+
+
+def lines_spacing(rhos: List[float], image_length: int) -> Tuple[float, float]:
     diffs = sorted(np.diff(rhos))
     avg = float(np.median(diffs))
     n_lines_with_average_value = float(np.sum(np.abs(np.array(diffs) - avg) < image_length / 500))
     ratio_lines_with_average_value = n_lines_with_average_value / len(rhos)
 
-    reasonable_number_of_lines = 8 < len(rhos) < 100
+    reasonable_number_of_lines = min_lines <= len(rhos) < max_lines
     # assume at least 120 lines
     reasonable_px_per_inch = avg > image_length / 120
 
     overall_reasonable_result = all([reasonable_number_of_lines, reasonable_px_per_inch])
 
-    return avg, ratio_lines_with_average_value if overall_reasonable_result else 0.0, rhos
+    return avg, ratio_lines_with_average_value if overall_reasonable_result else 0.0
+
+
+def grid_phase(rhos: List[float], px_per_inch: float) -> Optional[float]:
+    """Find the position of the first grid line from the positions of the detected lines.
+
+    The positions are averaged as angles on a circle with the grid spacing as circumference, so
+    a missing or extra line doesn't matter much. The position is in pixel coordinates, where the
+    center of the first pixel is at 0.5.
+    """
+    if not rhos:
+        return None
+    angles = 2 * np.pi * np.asarray(rhos) / px_per_inch
+    mean = np.mean(np.exp(1j * angles))
+    if np.abs(mean) < phase_min_consistency:
+        # the lines don't line up with the spacing
+        return None
+    phase = np.angle(mean) / (2 * np.pi) * px_per_inch + 0.5
+    return float(phase % px_per_inch)
+
+
+def downsample(image, factor: float):
+    height, width = image.shape[:2]
+    size = (int(round(width / factor)), int(round(height / factor)))
+    # grid lines are usually darker than the map, take the minimum first so thin lines
+    # don't fade away when averaging
+    kernel_size = int(np.ceil(factor))
+    image = cv2.erode(image, np.ones((kernel_size, kernel_size), dtype=np.uint8))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+def refine_detection(
+    image,
+    rhos: List[float],
+    wanted_theta: float,
+    factor: float,
+    upper_threshold: float,
+) -> Tuple[float, float, List[float]]:
+    if len(rhos) <= 1:
+        return 10.0, 0.0, []
+    if not wanted_theta:
+        # strips of columns aren't contiguous in memory, find vertical lines in rows of the
+        # transposed image instead
+        image = cv2.transpose(image)
+    rhos = [
+        refine_line_position(
+            image=image,
+            position=(rho + 0.5) * factor - 0.5,
+            axis=0,
+            margin=factor + 1,
+            upper_threshold=upper_threshold,
+        )
+        for rho in rhos
+    ]
+    px_per_inch, confidence = lines_spacing(rhos=rhos, image_length=image.shape[1])
+    logger.debug("refined px per inch %.2f, confidence %.3f", px_per_inch, confidence)
+    return px_per_inch, confidence, rhos
+
+
+def refine_line_position(
+    image,
+    position: float,
+    axis: int,
+    margin: float,
+    upper_threshold: float,
+) -> float:
+    """Find a line close to a predicted position on a strip of the full resolution image."""
+    length = image.shape[axis]
+    start = max(int(np.floor(position - margin)), 0)
+    stop = min(int(np.ceil(position + margin)) + 1, length)
+    # add some extra pixels around the strip so edge detection has context
+    padding = 2
+    strip_start = max(start - padding, 0)
+    strip_stop = min(stop + padding, length)
+    strip = image[strip_start:strip_stop] if axis == 0 else image[:, strip_start:strip_stop]
+
+    edges = image_to_edges(strip, upper_threshold=upper_threshold)
+    # for an axis-aligned line, the votes in the Hough accumulator are the edge pixel counts
+    votes = np.pad(edges.sum(axis=1 - axis, dtype=np.int64), 1)
+    votes = votes[start - strip_start : stop - strip_start + 2]
+    votes_center = votes[1:-1]
+    is_peak = (
+        (votes_center > votes[:-2])
+        & (votes_center >= votes[2:])
+        & (votes_center >= votes_center.max() / 2)
+    )
+    if not is_peak.any():
+        # no line within the margin, for example when the edges only rise towards its border
+        return position
+    return start + float(np.mean(np.flatnonzero(is_peak)))
 
 
-def image_to_edges(image):
-    grey = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+def to_grey(image):
+    if image.ndim == 2:
+        return image
+    return cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY if image.shape[2] == 4 else cv2.COLOR_BGR2GRAY)
 
+
+def canny_upper_threshold(image) -> float:
+    grey = to_grey(image)
     # determine upper threshold for Canny (https://stackoverflow.com/a/16047590)
     upper_threshold, _ = cv2.threshold(grey, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    return upper_threshold
+
+
+def image_to_edges(image, upper_threshold: Optional[float] = None):
+    if upper_threshold is None:
+        upper_threshold = canny_upper_threshold(image)
+
+    grey = to_grey(image)
 
     # detect edges, result is black and white image
     # lower edge should be low enough to get low contract lines
@@ -153,12 +973,56 @@ def image_to_edges(image):
     return edges
 
 
-def edges_to_lines(edges, threshold: float) -> List[Tuple[float, float]]:
-    lines = cv2.HoughLines(image=edges, rho=1, theta=np.pi / 180, threshold=threshold)  # type: ignore
-    if lines is None:
-        return []
-    lines = [tuple(line[0]) for line in lines]
-    return lines
+class HoughAccumulator:
+    """Hough transform of an edge image, computed once and queried for any vote threshold.
+
+    The accumulator peaks are collected at the lowest possible threshold together with their
+    votes, so a query gives the same lines as `cv2.HoughLines` with that threshold would.
+
+    With `wanted_theta`, only the angle bin of that orientation and its direct neighbours get
+    votes. The neighbours are needed to find the same local maxima as the full transform.
+    """
+
+    def __init__(self, edges, wanted_theta: Optional[float] = None):
+        if wanted_theta is None:
+            min_theta, max_theta = 0.0, np.pi
+        else:
+            n_bins = int(round(np.pi / theta_step))
+            wanted_bin = int(round(wanted_theta / theta_step))
+            first_bin = max(wanted_bin - 1, 0)
+            last_bin = min(wanted_bin + 1, n_bins - 1)
+            min_theta = _theta_of_bin(first_bin)
+            max_theta = min_theta + (last_bin - first_bin + 0.5) * theta_step
+        lines = cv2.HoughLinesWithAccumulator(
+            image=edges,
+            rho=1,
+            theta=theta_step,
+            threshold=0,
+            min_theta=min_theta,
+            max_theta=max_theta,
+        )
+        if lines is None:
+            lines = np.empty((0, 3), dtype=np.float32)
+        # columns are rho, theta and votes
+        self._lines = lines.reshape(-1, 3)
+
+    def lines(self, threshold: float) -> List[Tuple[float, float]]:
+        selected = self._lines[self._lines[:, 2] > threshold]
+        return [(rho, theta) for rho, theta, _ in selected.tolist()]
+
+    def votes(self, wanted_theta: float) -> List[int]:
+        """Votes of the lines with the wanted orientation, from high to low."""
+        selected = self._lines[np.abs(self._lines[:, 1] - wanted_theta) < 0.01]
+        return sorted((int(votes) for votes in selected[:, 2]), reverse=True)
+
+
+def _theta_of_bin(i: int) -> float:
+    # OpenCV fills its angle table by repeatedly adding the step as a float32, start a band at
+    # the same value so its votes are identical to those of the full transform
+    theta = np.float32(0)
+    for _ in range(i):
+        theta += np.float32(theta_step)
+    return float(theta)
 
 
 def keep_only_lines_with_certain_orientation(
@@ -207,6 +1071,7 @@ def polar_to_cartesian(
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
     find_image_scale(
         image_path=r"C:\Users\frank\Documents\Battle maps\f079483060cc8abafba9ea72f8bb5722.jpg",
         show_result=True,
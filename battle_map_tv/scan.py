@@ -0,0 +1,105 @@
+import multiprocessing
+import os
+import os.path
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+
+from battle_map_tv.scale_detection import ScaleDetectionResult, SearchHint, detect_image_scale
+from battle_map_tv.search_history import add_to_search_history, get_search_hint
+from battle_map_tv.storage import ImageKeys, get_images_from_storage, set_images_in_storage
+
+image_extensions = (".png", ".jpg", ".jpeg", ".webp", ".bmp", ".tif", ".tiff")
+# seconds between writes of the results to storage
+store_interval = 10.0
+
+
+def find_images(directory: str) -> List[str]:
+    image_paths = []
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if filename.lower().endswith(image_extensions):
+                image_paths.append(os.path.join(dirpath, filename))
+    return sorted(image_paths)
+
+
+def _detect(
+    image_path: str, memory_cap: Optional[int] = None, hint: Optional[SearchHint] = None
+) -> Tuple[str, Optional[ScaleDetectionResult], Optional[str]]:
+    try:
+        result = detect_image_scale(image_path, memory_cap=memory_cap, hint=hint)
+    except Exception as e:
+        return image_path, None, str(e) or type(e).__name__
+    return image_path, result, None
+
+
+def _store(
+    px_per_inch: Dict[str, Optional[float]],
+    grid_phase: Dict[str, list],
+    detected: List[ScaleDetectionResult],
+):
+    set_images_in_storage(ImageKeys.px_per_inch, px_per_inch)
+    set_images_in_storage(ImageKeys.grid_phase, grid_phase)
+    add_to_search_history(detected)
+
+
+def scan_directory(
+    directory: str,
+    processes: Optional[int] = None,
+    rescan: bool = False,
+    memory_cap: Optional[int] = None,
+) -> Dict[str, Optional[float]]:
+    """Detect the scale of all images in a directory and save the results in storage.
+
+    The scale is stored as pixels per inch, or None if an image has no grid, together with the
+    position of the grid lines on the image. Images that already have a detected scale in storage
+    are skipped, unless `rescan` is set.
+    With a `memory_cap` in bytes per process, big images are detected on a sample of tiles.
+    Results are saved along the way, so an interrupted scan continues where it stopped.
+    """
+    image_paths = find_images(directory)
+    if not rescan:
+        done = get_images_from_storage(ImageKeys.px_per_inch)
+        image_paths = [path for path in image_paths if os.path.basename(path) not in done]
+    print(f"Scanning {len(image_paths)} images in {directory}")
+
+    results: Dict[str, Optional[float]] = {}
+    to_store: Dict[str, Optional[float]] = {}
+    phases_to_store: Dict[str, list] = {}
+    detected: List[ScaleDetectionResult] = []
+    last_stored = time.monotonic()
+    # forking a process that runs threads, like those of OpenCV, can deadlock
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+        # the hint is taken once, the processes don't share the storage
+        detect = partial(_detect, memory_cap=memory_cap, hint=get_search_hint())
+        futures = [executor.submit(detect, image_path) for image_path in image_paths]
+        try:
+            for i, future in enumerate(as_completed(futures), start=1):
+                image_path, result, error = future.result()
+                if result is None:
+                    print(f"[{i}/{len(futures)}] {image_path}: failed, {error}")
+                    continue
+                px_per_inch = result.px_per_inch if result.grid_found else None
+                if px_per_inch is None:
+                    print(f"[{i}/{len(futures)}] {image_path}: no grid found")
+                else:
+                    print(f"[{i}/{len(futures)}] {image_path}: {px_per_inch:.1f} px per inch")
+                image_filename = os.path.basename(image_path)
+                results[image_filename] = px_per_inch
+                to_store[image_filename] = px_per_inch
+                phases_to_store[image_filename] = [result.phase_x, result.phase_y]
+                detected.append(result)
+                if time.monotonic() - last_stored > store_interval:
+                    _store(to_store, phases_to_store, detected)
+                    to_store = {}
+                    phases_to_store = {}
+                    detected = []
+                    last_stored = time.monotonic()
+        finally:
+            for future in futures:
+                future.cancel()
+            if to_store:
+                _store(to_store, phases_to_store, detected)
+    return results
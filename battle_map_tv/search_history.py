@@ -0,0 +1,33 @@
+from typing import List, Optional
+
+import numpy as np
+
+from battle_map_tv.scale_detection import ScaleDetectionResult, SearchHint
+from battle_map_tv.storage import StorageKeys, get_from_storage, set_in_storage
+
+# number of recent line coverages that are kept, from both axes of each image
+max_entries = 100
+# with fewer it's too early to tell what's typical
+min_entries = 6
+
+
+def get_search_hint() -> Optional[SearchHint]:
+    """Hint for the threshold search from the images where a grid was found before."""
+    coverages = get_from_storage(StorageKeys.line_coverage_history, default=[])
+    if len(coverages) < min_entries:
+        return None
+    low, median, high = np.percentile(coverages, [10, 50, 90])
+    return SearchHint(coverage=float(median), low=float(low), high=float(high))
+
+
+def add_to_search_history(results: List[ScaleDetectionResult]):
+    # results from the cache have no metrics, they were added when they were detected
+    coverages = [
+        coverage
+        for result in results
+        if result.grid_found and result.metrics is not None
+        for coverage in result.metrics.line_coverage
+    ]
+    if coverages:
+        history = get_from_storage(StorageKeys.line_coverage_history, default=[])
+        set_in_storage(StorageKeys.line_coverage_history, (history + coverages)[-max_entries:])
@@ -32,6 +32,7 @@ class StorageKeys(Enum):
     thumbnail_1 = "thumbnail_1"
     thumbnail_2 = "thumbnail_2"
     thumbnail_3 = "thumbnail_3"
+    line_coverage_history = "line_coverage_history"
 
 
 class Undefined:
@@ -64,6 +65,8 @@ class ImageKeys(Enum):
     scale = "scale"
     position = "position"
     rotation = "rotation"
+    px_per_inch = "px_per_inch"
+    grid_phase = "grid_phase"
 
 
 def get_image_from_storage(
@@ -86,3 +89,20 @@ def set_image_in_storage(image_filename: str, key: ImageKeys, value):
     image_data = data.setdefault(image_filename, {})
     image_data[key.value] = value
     _dump(data)
+
+
+def get_images_from_storage(key: ImageKeys) -> Dict[str, Any]:
+    data = _load()
+    return {
+        image_filename: image_data[key.value]
+        for image_filename, image_data in data.items()
+        if isinstance(image_data, dict) and key.value in image_data
+    }
+
+
+def set_images_in_storage(key: ImageKeys, values: Dict[str, Any]):
+    data = _load()
+    for image_filename, value in values.items():
+        image_data = data.setdefault(image_filename, {})
+        image_data[key.value] = value
+    _dump(data)
@@ -0,0 +1,386 @@
+import math
+from dataclasses import dataclass
+from functools import partial
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from PySide6.QtCore import QRect, QRectF, QSize
+from PySide6.QtGui import QImage, QPainter, QTransform
+from PySide6.QtWidgets import QGraphicsItem
+
+from battle_map_tv.scale_detection import to_grey
+from battle_map_tv.utils import qimage_to_array
+from battle_map_tv.workers import ProgressCallback, Worker
+
+# width and height in pixels of the tiles, of every level
+tile_size = 1024
+
+
+@dataclass
+class TileLevel:
+    """The image at one level of detail, cut into tiles of `tile_size` by `tile_size` pixels."""
+
+    width: int
+    height: int
+    format: QImage.Format
+    # rows of tiles, from the top left
+    tiles: List[List[QImage]]
+
+
+def paint_format(image: QImage) -> QImage.Format:
+    # the raster paint engine draws these formats without converting them
+    if image.hasAlphaChannel():
+        return QImage.Format.Format_ARGB32_Premultiplied
+    return QImage.Format.Format_RGB32
+
+
+def cut_into_tiles(image: QImage) -> List[List[QImage]]:
+    return [
+        [
+            image.copy(QRect(x, y, tile_size, tile_size).intersected(image.rect()))
+            for x in range(0, image.width(), tile_size)
+        ]
+        for y in range(0, image.height(), tile_size)
+    ]
+
+
+def build_level(image: QImage) -> TileLevel:
+    """Cut the image into tiles, tiles at the edges are smaller than `tile_size`."""
+    image = image.convertToFormat(paint_format(image))
+    return TileLevel(image.width(), image.height(), image.format(), cut_into_tiles(image))
+
+
+def downscale_level(level: TileLevel) -> TileLevel:
+    """The level at half the size, with each tile made from two by two tiles of `level`."""
+    tiles = []
+    for row in range(0, len(level.tiles), 2):
+        tiles_row = []
+        for col in range(0, len(level.tiles[0]), 2):
+            block = np.concatenate(
+                [
+                    np.concatenate(
+                        [qimage_to_array(tile) for tile in tiles_row_in[col : col + 2]], axis=1
+                    )
+                    for tiles_row_in in level.tiles[row : row + 2]
+                ],
+                axis=0,
+            )
+            height, width = block.shape[:2]
+            small = cv2.resize(
+                block,
+                (math.ceil(width / 2), math.ceil(height / 2)),
+                interpolation=cv2.INTER_AREA,
+            )
+            tile = QImage(
+                small.data, small.shape[1], small.shape[0], small.strides[0], level.format
+            )
+            # the QImage doesn't own the pixels of the array, so copy them
+            tiles_row.append(tile.copy())
+        tiles.append(tiles_row)
+    return TileLevel(math.ceil(level.width / 2), math.ceil(level.height / 2), level.format, tiles)
+
+
+def build_pyramid(level: TileLevel, progress: Optional[ProgressCallback] = None) -> List[TileLevel]:
+    """Downscale the level by halves until it fits in one tile."""
+    n_levels = max(math.ceil(math.log2(max(level.width, level.height) / tile_size)), 0)
+    levels = []
+    for i in range(n_levels):
+        level = downscale_level(level)
+        levels.append(level)
+        if progress is not None:
+            progress((i + 1) / n_levels)
+    return levels
+
+
+def choose_level(level_of_detail: float, n_levels: int) -> int:
+    """The smallest level that has at least as many pixels as are shown on the screen."""
+    if level_of_detail <= 0:
+        return n_levels - 1
+    return min(max(math.floor(math.log2(1 / level_of_detail)), 0), n_levels - 1)
+
+
+def scale_rect(rect: QRectF, scale_x: float, scale_y: float) -> QRectF:
+    return QRectF(
+        rect.x() * scale_x,
+        rect.y() * scale_y,
+        rect.width() * scale_x,
+        rect.height() * scale_y,
+    )
+
+
+def tiles_in_rect(level: TileLevel, rect: QRectF) -> Iterator[Tuple[QRect, QImage]]:
+    """The tiles that overlap `rect`, and their positions, in pixels of the level."""
+    first_col = max(math.floor(rect.left() / tile_size), 0)
+    last_col = min(math.ceil(rect.right() / tile_size), math.ceil(level.width / tile_size))
+    first_row = max(math.floor(rect.top() / tile_size), 0)
+    last_row = min(math.ceil(rect.bottom() / tile_size), math.ceil(level.height / tile_size))
+    for row in range(first_row, last_row):
+        for col in range(first_col, last_col):
+            tile = level.tiles[row][col]
+            yield QRect(col * tile_size, row * tile_size, tile.width(), tile.height()), tile
+
+
+def level_region(level: TileLevel, rect: QRect, grey: bool = False) -> np.ndarray:
+    """Copy the pixels of `rect`, in pixels of the level, out of the tiles.
+
+    With `grey`, each tile is converted to grey while it's copied, which takes a quarter of the
+    memory of a copy in color.
+    """
+    shape: Tuple[int, ...] = (rect.height(), rect.width())
+    if not grey:
+        shape += qimage_to_array(level.tiles[0][0]).shape[2:]
+    region = np.empty(shape, dtype=np.uint8)
+    for tile_rect, tile in tiles_in_rect(level, QRectF(rect)):
+        overlap = tile_rect.intersected(rect)
+        x, y = overlap.x() - tile_rect.x(), overlap.y() - tile_rect.y()
+        pixels = qimage_to_array(tile)[y : y + overlap.height(), x : x + overlap.width()]
+        if grey:
+            pixels = to_grey(pixels)
+        region[
+            overlap.y() - rect.y() : overlap.bottom() + 1 - rect.y(),
+            overlap.x() - rect.x() : overlap.right() + 1 - rect.x(),
+        ] = pixels
+    return region
+
+
+# OpenCV rotations by a number of quarter turns clockwise
+rotate_codes = {
+    1: cv2.ROTATE_90_CLOCKWISE,
+    2: cv2.ROTATE_180,
+    3: cv2.ROTATE_90_COUNTERCLOCKWISE,
+}
+
+
+def rotate_level(level: TileLevel, quarter_turns: int) -> TileLevel:
+    """The level rotated clockwise, cut into tiles again."""
+    width, height = level.width, level.height
+    if quarter_turns % 2:
+        width, height = height, width
+    tiles = []
+    for y in range(0, height, tile_size):
+        tiles_row = []
+        for x in range(0, width, tile_size):
+            w, h = min(tile_size, width - x), min(tile_size, height - y)
+            # the part of the level that ends up in this tile
+            if quarter_turns == 1:
+                source = QRect(y, level.height - x - w, h, w)
+            elif quarter_turns == 2:
+                source = QRect(level.width - x - w, level.height - y - h, w, h)
+            else:
+                source = QRect(level.width - y - h, x, h, w)
+            rotated = cv2.rotate(level_region(level, source), rotate_codes[quarter_turns])
+            tile = QImage(rotated.data, w, h, rotated.strides[0], level.format)
+            # the QImage doesn't own the pixels of the array, so copy them
+            tiles_row.append(tile.copy())
+        tiles.append(tiles_row)
+    return TileLevel(width, height, level.format, tiles)
+
+
+def rotate_levels(
+    levels: List[TileLevel],
+    quarter_turns: int,
+    progress: Optional[ProgressCallback] = None,
+) -> List[TileLevel]:
+    rotated = []
+    for i, level in enumerate(levels):
+        rotated.append(rotate_level(level, quarter_turns))
+        if progress is not None:
+            progress((i + 1) / len(levels))
+    return rotated
+
+
+# signs of the x and y of where the x and y axis end up, for each number of quarter turns
+quarter_turn_axes: Dict[Tuple[int, ...], int] = {
+    (1, 0, 0, 1): 0,
+    (0, 1, -1, 0): 1,
+    (-1, 0, 0, -1): 2,
+    (0, -1, 1, 0): 3,
+}
+
+
+def quarter_turns(transform: QTransform) -> Optional[int]:
+    """The number of quarter turns clockwise of a transform that only rotates by multiples of
+    90 degrees, scales and moves, otherwise None.
+    """
+    if transform.type() == QTransform.TransformationType.TxProject:
+        return None
+    # where the x and y axis end up
+    x_axis = (transform.m11(), transform.m12())
+    y_axis = (transform.m21(), transform.m22())
+    signs = tuple(
+        0 if abs(value) < 1e-9 * max(map(abs, x_axis + y_axis)) else int(np.sign(value))
+        for value in x_axis + y_axis
+    )
+    return quarter_turn_axes.get(signs)
+
+
+class TiledImageItem(QGraphicsItem):
+    """Show an image that is cut into tiles, at several levels of detail.
+
+    Only the tiles that are exposed are painted, from the level that fits the zoom. This keeps
+    painting fast for huge images, where scaling the whole image on every paint is slow.
+    The smaller levels are made in the background, until then the full image is painted.
+
+    When it's rotated by 90 or 270 degrees, rotated tiles are made in the background too. Those
+    are drawn without rotating, which is much faster in the raster paint engine. Only the tiles of
+    the current rotation are kept.
+    """
+
+    def __init__(
+        self,
+        image: QImage,
+        size: Optional[QSize] = None,
+        parent: Optional[QGraphicsItem] = None,
+    ):
+        super().__init__(parent)
+        self.levels: List[TileLevel] = []
+        self.image_size = QSize()
+        self._pyramid_worker: Optional[Worker] = None
+        # levels rotated by a number of quarter turns
+        self._rotated: Dict[int, List[TileLevel]] = {}
+        self._rotate_worker: Optional[Worker] = None
+        self.setFlag(self.GraphicsItemFlag.ItemUsesExtendedStyleOption)
+        self.set_image(image, size=size)
+
+    def set_image(self, image: QImage, size: Optional[QSize] = None):
+        """Show the image, or with a `size` show it as a preview of an image of that size."""
+        self.set_levels([build_level(image)], size=size)
+
+    def set_levels(self, levels: List[TileLevel], size: Optional[QSize] = None):
+        """Show the levels of an image, the smaller levels are made if they're missing."""
+        self.cancel_pyramid()
+        self.cancel_rotate()
+        self.prepareGeometryChange()
+        self.image_size = QSize(levels[0].width, levels[0].height) if size is None else size
+        self.levels = levels
+        self._rotated = {}
+        self.update()
+        if max(levels[-1].width, levels[-1].height) > tile_size:
+            worker = Worker(partial(build_pyramid, levels[-1]))
+            worker.signals.result.connect(partial(self._set_pyramid, worker))
+            self._pyramid_worker = worker.start()
+
+    def _set_pyramid(self, worker: Worker, levels: List[TileLevel]):
+        if not worker.is_cancelled():
+            self.cancel_rotate()
+            self.levels = self.levels + levels
+            self._rotated = {}
+            self._pyramid_worker = None
+            self.update()
+
+    def cancel_pyramid(self):
+        if self._pyramid_worker is not None:
+            self._pyramid_worker.cancel()
+            self._pyramid_worker = None
+
+    def _start_rotate(self, turns: int):
+        # rotate the pyramid when it's complete, instead of rotating the levels twice
+        if self._pyramid_worker is not None or self._rotate_worker is not None:
+            return
+        worker = Worker(partial(rotate_levels, self.levels, turns))
+        worker.signals.result.connect(partial(self._set_rotated, worker, turns))
+        self._rotate_worker = worker.start()
+
+    def _set_rotated(self, worker: Worker, turns: int, levels: List[TileLevel]):
+        if not worker.is_cancelled():
+            self._rotated = {turns: levels}
+            self._rotate_worker = None
+            self.update()
+
+    def cancel_rotate(self):
+        if self._rotate_worker is not None:
+            self._rotate_worker.cancel()
+            self._rotate_worker = None
+
+    def more_detail_needed(self):
+        """Called when the image is shown bigger than the pixels it has, like a preview."""
+
+    def width(self) -> int:
+        return self.image_size.width()
+
+    def height(self) -> int:
+        return self.image_size.height()
+
+    def is_preview(self) -> bool:
+        return self.levels[0].width < self.width() or self.levels[0].height < self.height()
+
+    def format(self) -> QImage.Format:
+        return self.levels[0].format
+
+    def rect(self) -> QRect:
+        return QRect(0, 0, self.width(), self.height())
+
+    def to_image(self, rect: Optional[QRect] = None) -> QImage:
+        """Copy the pixels of the full image, or of `rect` within it, into one image."""
+        if self.is_preview():
+            raise ValueError("Only a preview of the image is shown")
+        if rect is None:
+            rect = self.rect()
+        rect = rect.intersected(self.rect())
+        image = QImage(rect.size(), self.format())
+        painter = QPainter(image)
+        painter.setCompositionMode(QPainter.CompositionMode.CompositionMode_Source)
+        for tile_rect, tile in tiles_in_rect(self.levels[0], QRectF(rect)):
+            painter.drawImage(tile_rect.topLeft() - rect.topLeft(), tile)
+        painter.end()
+        return image
+
+    def choose_level(self, level_of_detail: float, levels: List[TileLevel]) -> TileLevel:
+        """The level to paint at a level of detail of the full image."""
+        # the first level is smaller than the image when it's read at the display resolution,
+        # the longest sides are compared because the levels can be rotated
+        if not levels[0].tiles:
+            # a placeholder for an image that isn't read yet
+            return levels[0]
+        first_scale = max(levels[0].width, levels[0].height) / max(self.width(), self.height())
+        return levels[choose_level(level_of_detail / first_scale, len(levels))]
+
+    def boundingRect(self) -> QRectF:
+        if not self.levels:
+            return QRectF()
+        return QRectF(self.rect())
+
+    def paint(self, painter: QPainter, option, widget=None):
+        if not self.levels[0].tiles:
+            # a placeholder for an image that isn't read yet
+            return
+        level_of_detail = option.levelOfDetailFromTransform(painter.worldTransform())
+        level = self.choose_level(level_of_detail, self.levels)
+        if level_of_detail * self.width() > self.levels[0].width:
+            self.more_detail_needed()
+        turns = quarter_turns(painter.worldTransform())
+        # the raster paint engine draws upside down as fast as not rotated
+        if turns is not None and turns % 2:
+            if turns in self._rotated:
+                rotated = self._rotated[turns]
+                self._paint_rotated(painter, option.exposedRect, rotated, level_of_detail)
+                return
+            self._start_rotate(turns)
+        # size in pixels of the full image of a pixel of the level
+        scale_x = self.width() / level.width
+        scale_y = self.height() / level.height
+        exposed = scale_rect(option.exposedRect, 1 / scale_x, 1 / scale_y)
+        for tile_rect, tile in tiles_in_rect(level, exposed):
+            painter.drawImage(scale_rect(QRectF(tile_rect), scale_x, scale_y), tile)
+
+    def _paint_rotated(
+        self,
+        painter: QPainter,
+        exposed: QRectF,
+        levels: List[TileLevel],
+        level_of_detail: float,
+    ):
+        transform = painter.worldTransform()
+        # the rotated image is drawn in pixels of the device, which aren't rotated
+        item_rect = transform.mapRect(QRectF(self.rect()))
+        exposed = transform.mapRect(exposed).translated(-item_rect.topLeft())
+        level = self.choose_level(level_of_detail, levels)
+        scale_x = item_rect.width() / level.width
+        scale_y = item_rect.height() / level.height
+        painter.save()
+        painter.resetTransform()
+        for tile_rect, tile in tiles_in_rect(level, scale_rect(exposed, 1 / scale_x, 1 / scale_y)):
+            target = scale_rect(QRectF(tile_rect), scale_x, scale_y)
+            painter.drawImage(target.translated(item_rect.topLeft()), tile)
+        painter.restore()
@@ -1,7 +1,37 @@
 from typing import Tuple
 
+import numpy as np
 from PySide6.QtCore import QSize
+from PySide6.QtGui import QImage
 
 
 def size_to_tuple(size: QSize) -> Tuple[int, int]:
     return size.width(), size.height()
+
+
+# formats of which the pixels can be used by OpenCV as they are
+array_formats = (
+    QImage.Format.Format_RGB32,
+    QImage.Format.Format_ARGB32,
+    QImage.Format.Format_ARGB32_Premultiplied,
+    QImage.Format.Format_Grayscale8,
+)
+
+
+def qimage_to_array(image: QImage) -> np.ndarray:
+    """View the pixels of a QImage as a read-only BGRA or grey array, without copying them.
+
+    The view doesn't keep the QImage alive, keep a reference to it while the array is used.
+    """
+    if image.format() not in array_formats:
+        raise ValueError(f"Can't view QImage with format {image.format()}, convert it first")
+    # 32-bit pixels are stored as 0xAARRGGBB, that is BGRA in memory on little-endian machines
+    channels = 1 if image.format() == QImage.Format.Format_Grayscale8 else 4
+    array = np.ndarray(
+        shape=(image.height(), image.width(), channels),
+        dtype=np.uint8,
+        # unlike bits(), constBits() doesn't detach the QImage from a shared buffer
+        buffer=image.constBits(),
+        strides=(image.bytesPerLine(), channels, 1),
+    )
+    return array[:, :, 0] if channels == 1 else array
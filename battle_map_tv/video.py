@@ -0,0 +1,142 @@
+import math
+from collections import deque
+from functools import partial
+from typing import Deque, Optional, Tuple
+
+import cv2
+import numpy as np
+from PySide6.QtCore import QTimer
+from PySide6.QtGui import QImage, QImageReader
+
+from battle_map_tv.image import CustomGraphicsPixmapItem
+from battle_map_tv.tiled_image import TileLevel, build_level
+from battle_map_tv.workers import ProgressCallback, Worker
+
+video_extensions = (".gif", ".mp4", ".m4v", ".webm", ".mkv", ".mov")
+# number of decoded frames that are kept ahead of the shown frame
+buffer_frames = 8
+# frames per second when the file doesn't tell
+default_fps = 25.0
+
+
+def is_video(path: str) -> bool:
+    if not path.lower().endswith(video_extensions):
+        return False
+    if path.lower().endswith(".gif"):
+        # a GIF with a single frame is a still image
+        return QImageReader(path).imageCount() > 1
+    return True
+
+
+def open_video(video_path: str) -> Tuple[cv2.VideoCapture, float]:
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        raise ValueError(f"Can't read video {video_path}")
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    if not math.isfinite(fps) or fps <= 0:
+        fps = default_fps
+    return capture, fps
+
+
+def frame_to_level(frame: np.ndarray) -> TileLevel:
+    height, width = frame.shape[:2]
+    image = QImage(frame.data, width, height, frame.strides[0], QImage.Format.Format_BGR888)
+    # converting copies the pixels, so the QImage doesn't depend on the array
+    return build_level(image.convertToFormat(QImage.Format.Format_RGB32))
+
+
+def read_frame(capture: cv2.VideoCapture, video_path: str) -> TileLevel:
+    """Read the next frame, and start at the first one again after the last."""
+    ok, frame = capture.read()
+    if not ok:
+        # seeking isn't supported by all formats, so open the file again
+        capture.open(video_path)
+        ok, frame = capture.read()
+        if not ok:
+            raise ValueError(f"Can't read a frame of video {video_path}")
+    return frame_to_level(frame)
+
+
+def decode_frames(
+    capture: cv2.VideoCapture,
+    video_path: str,
+    buffer: Deque[TileLevel],
+    progress: Optional[ProgressCallback] = None,
+):
+    """Fill the buffer with the next frames of the video."""
+    n_frames = (buffer.maxlen or 0) - len(buffer)
+    for i in range(n_frames):
+        buffer.append(read_frame(capture, video_path))
+        if progress is not None:
+            progress((i + 1) / n_frames)
+
+
+class VideoItem(CustomGraphicsPixmapItem):
+    """An animated map, like a GIF or a video, which plays in a loop.
+
+    Frames are decoded in the background into a buffer of `buffer_frames` frames. A timer shows
+    the next frame from the buffer, and the buffer is filled again when it's half empty. When
+    decoding can't keep up, the current frame stays on screen. When decoding fails, the video
+    stops at the current frame.
+    """
+
+    def __init__(self, video_path: str):
+        self._capture, self.fps = open_video(video_path)
+        self._buffer: Deque[TileLevel] = deque(maxlen=buffer_frames)
+        self._decode_worker: Optional[Worker] = None
+        self._timer = QTimer()
+        self._timer.setInterval(round(1000 / self.fps))
+        self._timer.timeout.connect(self.next_frame)
+        # the first frame is read right away, so the item has its size
+        super().__init__(video_path, levels=[read_frame(self._capture, video_path)])
+        # only the current frame is shown, without smaller levels of detail
+        self.cancel_pyramid()
+
+    def start_loading(self, display_resolution: bool = False):
+        self._start_decoding()
+        self._timer.start()
+
+    def more_detail_needed(self):
+        pass
+
+    def _start_rotate(self, turns: int):
+        # the frames change too often to rotate them in the background
+        pass
+
+    def _start_decoding(self):
+        if self._decode_worker is not None:
+            return
+        worker = Worker(partial(decode_frames, self._capture, self.image_path, self._buffer))
+        worker.signals.result.connect(partial(self._decoded, worker))
+        worker.signals.finished.connect(partial(self._decode_finished, worker))
+        self._decode_worker = worker.start()
+
+    def _decoded(self, worker: Worker, _):
+        if worker is self._decode_worker:
+            self._decode_worker = None
+
+    def _decode_finished(self, worker: Worker):
+        if worker.is_cancelled():
+            # the worker doesn't read from the capture anymore
+            self._capture.release()
+        elif worker is self._decode_worker:
+            # without a result decoding failed, don't try again on every frame
+            self._decode_worker = None
+            self._timer.stop()
+
+    def next_frame(self):
+        # deque is thread-safe for appending on one end and popping on the other
+        if self._buffer:
+            self.levels = [self._buffer.popleft()]
+            self.update()
+        if len(self._buffer) <= buffer_frames // 2:
+            self._start_decoding()
+
+    def cancel_loading(self):
+        self._timer.stop()
+        if self._decode_worker is None:
+            self._capture.release()
+        else:
+            # the capture is released when the worker has stopped
+            self._decode_worker.cancel()
+        super().cancel_loading()
@@ -1,6 +1,6 @@
 from typing import Optional
 
-from PySide6.QtCore import Qt
+from PySide6.QtCore import Qt, QTimer, QRectF
 from PySide6.QtWidgets import (
     QLabel,
     QHBoxLayout,
@@ -129,13 +129,65 @@ class GuiWindow(QWidget):
         button.clicked.connect(callback_button_rotate_image)
         container.addWidget(button)
 
+        def start_autoscale(region: Optional[QRectF] = None):
+            if self.image_window.image is not None:
+                worker = self.image_window.image.autoscale(
+                    grid=self.image_window.grid, region=region
+                )
+                if worker is None:
+                    button_autoscale_cancel.setEnabled(False)
+                    return
+                button_autoscale.setEnabled(False)
+                button_autoscale_region.setEnabled(False)
+                button_autoscale_cancel.setEnabled(True)
+                worker.signals.progress.connect(
+                    lambda value: button_autoscale.setText(f"{value:.0%}")
+                )
+                worker.signals.finished.connect(autoscale_finished_callback)
+
         def button_autoscale_callback():
+            self.image_window.cancel_select_region()
+            start_autoscale()
+
+        def button_autoscale_region_callback():
+            if self.image_window.image is not None:
+                # detect on a rectangle that's dragged over the map next
+                self.image_window.select_region(callback=start_autoscale)
+                button_autoscale_cancel.setEnabled(True)
+
+        def autoscale_finished_callback():
+            if button_autoscale.text() != no_grid_text:
+                button_autoscale.setText("Autoscale")
+            button_autoscale.setEnabled(True)
+            button_autoscale_region.setEnabled(True)
+            button_autoscale_cancel.setEnabled(False)
+
+        no_grid_text = "No grid found"
+
+        def no_grid_found_callback():
+            button_autoscale.setText(no_grid_text)
+            QTimer.singleShot(3000, lambda: button_autoscale.setText("Autoscale"))
+
+        def button_autoscale_cancel_callback():
+            self.image_window.cancel_select_region()
+            button_autoscale_cancel.setEnabled(False)
             if self.image_window.image is not None:
-                self.image_window.image.autoscale(grid=self.image_window.grid)
+                self.image_window.image.cancel_autoscale()
 
-        button = StyledButton("Autoscale")
-        button.clicked.connect(button_autoscale_callback)
-        container.addWidget(button)
+        button_autoscale = StyledButton("Autoscale")
+        button_autoscale.clicked.connect(button_autoscale_callback)
+        container.addWidget(button_autoscale)
+
+        button_autoscale_region = StyledButton("Autoscale area")
+        button_autoscale_region.clicked.connect(button_autoscale_region_callback)
+        container.addWidget(button_autoscale_region)
+
+        button_autoscale_cancel = StyledButton("Cancel")
+        button_autoscale_cancel.clicked.connect(button_autoscale_cancel_callback)
+        button_autoscale_cancel.setEnabled(False)
+        container.addWidget(button_autoscale_cancel)
+
+        global_event_dispatcher.add_handler(EventKeys.no_grid_found, no_grid_found_callback)
 
     def add_row_scale_slider(self):
         container = self._create_container()
@@ -1,19 +1,24 @@
+import os.path
 from typing import Optional, Callable
 
-from PySide6.QtCore import Qt
+from PySide6.QtCore import Qt, QRectF
 from PySide6.QtGui import QMouseEvent
 from PySide6.QtWidgets import QGraphicsView, QGraphicsScene
 
 from battle_map_tv.aoe import AreaOfEffectManager
 from battle_map_tv.grid import GridOverlay, Grid
-from battle_map_tv.image import Image
+from battle_map_tv.image import CustomGraphicsPixmapItem, Image
+from battle_map_tv.image_cache import ImageCache, default_budget
 from battle_map_tv.initiative import InitiativeOverlayManager
+from battle_map_tv.package import is_package, read_package, settings_to_storage
+from battle_map_tv.region_selector import RegionSelector
 from battle_map_tv.storage import get_from_storage, StorageKeys
 from battle_map_tv.ui_elements import get_window_icon
+from battle_map_tv.video import VideoItem, is_video
 
 
 class ImageWindow(QGraphicsView):
-    def __init__(self):
+    def __init__(self, image_cache_budget: int = default_budget, display_resolution: bool = False):
         super().__init__()
         self.setWindowTitle("Battle Map TV")
         self.setWindowIcon(get_window_icon())
@@ -32,10 +37,13 @@ class ImageWindow(QGraphicsView):
         self.setScene(scene)
 
         self.image: Optional[Image] = None
+        self.image_cache = ImageCache(budget=image_cache_budget)
+        self.display_resolution = display_resolution
         self.grid = Grid(window=self)
         self.grid_overlay: Optional[GridOverlay] = None
         self.initiative_overlay_manager = InitiativeOverlayManager(scene=scene)
         self.area_of_effect_manager = AreaOfEffectManager(window=self, grid=self.grid)
+        self.region_selector = RegionSelector(scene=scene)
 
     def toggle_fullscreen(self):
         if self.isFullScreen():
@@ -44,16 +52,39 @@ class ImageWindow(QGraphicsView):
             self.showFullScreen()
 
     def add_image(self, image_path: str):
+        pixmap_item: Optional[CustomGraphicsPixmapItem] = None
+        levels = None
+        if is_video(image_path):
+            pixmap_item = VideoItem(image_path)
+        else:
+            levels = self.image_cache.pop(image_path)
+        if levels is None and is_package(image_path):
+            package = read_package(image_path)
+            settings_to_storage(os.path.basename(image_path), package.settings)
+            levels = package.levels
         self.image = Image(
             image_path=image_path,
             scene=self.scene(),
             window_width_px=self.width(),
             window_height_px=self.height(),
+            grid=self.grid,
+            levels=levels,
+            pixmap_item=pixmap_item,
+            display_resolution=self.display_resolution,
         )
+        # reading the maps next to it at full resolution would undo the memory that mode saves
+        if not self.display_resolution:
+            self.image_cache.prefetch(image_path)
 
     def remove_image(self):
+        self.cancel_select_region()
         if self.image is not None:
             self.image.delete()
+            pixmap_item = self.image.pixmap_item
+            filepath = self.image.filepath
+            # packages are mapped in memory and open instantly again, videos change all the time
+            if not (pixmap_item.is_preview() or is_package(filepath) or is_video(filepath)):
+                self.image_cache.put(filepath, pixmap_item.levels)
             self.image = None
 
     def restore_image(self):
@@ -112,6 +143,12 @@ class ImageWindow(QGraphicsView):
     def clear_area_of_effect(self):
         self.area_of_effect_manager.clear_all()
 
+    def select_region(self, callback: Callable[[QRectF], None]):
+        self.region_selector.wait_for(callback=callback)
+
+    def cancel_select_region(self):
+        self.region_selector.cancel()
+
     def resizeEvent(self, event):
         super().resizeEvent(event)
         self.scene().setSceneRect(0, 0, self.size().width(), self.size().height())
@@ -119,21 +156,32 @@ class ImageWindow(QGraphicsView):
         if self.grid_overlay is not None:
             self.grid_overlay.reset()
 
+    def closeEvent(self, event):
+        # the maps next to the shown one aren't shown in this window anymore
+        self.image_cache.cancel_prefetch()
+        super().closeEvent(event)
+
     def keyPressEvent(self, event):
         if event.key() == Qt.Key_Escape and self.isFullScreen():  # type: ignore[attr-defined]
             self.toggle_fullscreen()
         super().keyPressEvent(event)
 
     def mousePressEvent(self, event: QMouseEvent):
+        if self.region_selector.mouse_press_event(event):
+            return
         if not self.area_of_effect_manager.mouse_press_event(event):
             super().mousePressEvent(event)
 
     def mouseMoveEvent(self, event: QMouseEvent):
         if event.buttons() != Qt.MouseButton.LeftButton:
             return
+        if self.region_selector.mouse_move_event(event):
+            return
         if not self.area_of_effect_manager.mouse_move_event(event):
             super().mouseMoveEvent(event)
 
     def mouseReleaseEvent(self, event: QMouseEvent):
+        if self.region_selector.mouse_release_event(event):
+            return
         if not self.area_of_effect_manager.mouse_release_event(event):
             super().mouseReleaseEvent(event)
@@ -0,0 +1,63 @@
+import threading
+import traceback
+from typing import Any, Callable
+
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, Signal
+
+# called with the fraction of the work that's done, may raise to stop the work
+ProgressCallback = Callable[[float], None]
+
+
+class WorkerCancelled(Exception):
+    pass
+
+
+class WorkerSignals(QObject):
+    progress = Signal(float)
+    result = Signal(object)
+    cancelled = Signal()
+    finished = Signal()
+
+
+class Worker(QRunnable):
+    """Run a function on the global thread pool and report back through Qt signals.
+
+    The function gets a `progress` keyword argument to report a fraction between 0 and 1.
+    After `cancel`, the next progress report raises `WorkerCancelled` to stop the function.
+    """
+
+    def __init__(self, fn: Callable[..., Any]):
+        super().__init__()
+        self.fn = fn
+        self.signals = WorkerSignals()
+        self._cancelled = threading.Event()
+
+    def start(self) -> "Worker":
+        QThreadPool.globalInstance().start(self)
+        return self
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def is_cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def report_progress(self, value: float):
+        if self.is_cancelled():
+            raise WorkerCancelled()
+        self.signals.progress.emit(value)
+
+    def run(self):
+        try:
+            result = self.fn(progress=self.report_progress)
+        except WorkerCancelled:
+            self.signals.cancelled.emit()
+        except Exception:
+            traceback.print_exc()
+        else:
+            if self.is_cancelled():
+                self.signals.cancelled.emit()
+            else:
+                self.signals.result.emit(result)
+        finally:
+            self.signals.finished.emit()
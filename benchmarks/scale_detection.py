@@ -0,0 +1,227 @@
+"""Benchmark the speed and accuracy of the grid scale detection.
+
+Run from the root of the repository, for example:
+
+    python -m benchmarks.scale_detection --synthetic 8000x6000:100 --output after.json
+    python -m benchmarks.scale_detection --output after.json --compare before.json
+
+Stage times come from the metrics of the detection result. They are summed over all calls, so
+stages that run in parallel threads can add up to more than the total wall time. Peak memory is
+measured with tracemalloc, which sees the numpy arrays, including those returned by OpenCV, but
+not OpenCV's internal buffers.
+"""
+
+import argparse
+import json
+import os.path
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import dataclass, field, asdict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from battle_map_tv import scale_detection
+from tests.test_scale_detection import expected_scales, images_path
+
+configs: Dict[str, Dict[str, Any]] = {
+    "hough": dict(engine="hough", pyramid=False),
+    "hough-pyramid": dict(engine="hough", pyramid=True),
+    "projection": dict(engine="projection", pyramid=False),
+    "auto": dict(engine="auto", pyramid=False),
+    "hough-tiled": dict(engine="hough", pyramid=False, memory_cap=64 * 2**20),
+}
+
+default_synthetic = ["2000x1500:50", "4000x3000:70.5", "8000x6000:100"]
+
+
+@dataclass
+class BenchmarkResult:
+    image: str
+    config: str
+    width: int
+    height: int
+    expected_px_per_inch: float
+    px_per_inch: float
+    confidence: float
+    error: float
+    wall_time: float
+    peak_memory: int
+    hough_calls: int
+    stages: Dict[str, scale_detection.StageTime] = field(default_factory=dict)
+    counters: Dict[str, int] = field(default_factory=dict)
+
+
+def synthetic_grid(width: int, height: int, px_per_square: float, seed: int = 0) -> np.ndarray:
+    """Create a map-like image with a known grid spacing."""
+    rng = np.random.default_rng(seed)
+    # smooth colored background with some noise
+    small = rng.integers(60, 200, (max(height // 64, 2), max(width // 64, 2), 3), dtype=np.uint8)
+    image = cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC)
+    noise = rng.normal(0, 8, (height, width, 1))
+    image = np.clip(image + noise, 0, 255).astype(np.uint8)
+    # circles as artwork that isn't part of the grid
+    max_radius = max(min(width, height) // 10, 11)
+    for _ in range(max(width * height // 200_000, 5)):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        color = tuple(int(c) for c in rng.integers(0, 255, 3))
+        radius = int(rng.integers(10, max_radius))
+        cv2.circle(image, center, radius, color, int(rng.integers(-1, 4)))
+    # semi-transparent grid lines with a random offset
+    overlay = image.copy()
+    offset = rng.uniform(0, px_per_square, 2)
+    thickness = max(int(round(px_per_square / 50)), 1)
+    for x in np.arange(offset[0], width, px_per_square):
+        x = int(round(x))
+        cv2.line(overlay, (x, 0), (x, height - 1), (20, 20, 20), thickness)
+    for y in np.arange(offset[1], height, px_per_square):
+        y = int(round(y))
+        cv2.line(overlay, (0, y), (width - 1, y), (20, 20, 20), thickness)
+    return cv2.addWeighted(overlay, 0.6, image, 0.4, 0)
+
+
+def parse_synthetic(value: str) -> Tuple[int, int, float]:
+    size, px_per_square = value.split(":")
+    width, height = size.lower().split("x")
+    return int(width), int(height), float(px_per_square)
+
+
+def run_detection(image_path: str, config: Dict[str, Any]) -> scale_detection.ScaleDetectionResult:
+    return scale_detection.detect_image_scale(image_path, **config)
+
+
+def run_timed(
+    image_path: str, config: Dict[str, Any]
+) -> Tuple[scale_detection.ScaleDetectionResult, float]:
+    start = time.perf_counter()
+    result = run_detection(image_path, config)
+    return result, time.perf_counter() - start
+
+
+def measure_peak_memory(fn: Callable[[], Any]) -> int:
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def benchmark_image(
+    name: str,
+    image_path: str,
+    expected_px_per_inch: float,
+    config_name: str,
+    repeat: int,
+) -> BenchmarkResult:
+    config = configs[config_name]
+    runs = [run_timed(image_path, config) for _ in range(repeat)]
+    result, wall_time = min(runs, key=lambda run: run[1])
+    assert result.metrics is not None
+    peak_memory = measure_peak_memory(lambda: run_detection(image_path, config))
+    height, width = cv2.imread(image_path).shape[:2]  # type: ignore[union-attr]
+    return BenchmarkResult(
+        image=name,
+        config=config_name,
+        width=width,
+        height=height,
+        expected_px_per_inch=expected_px_per_inch,
+        px_per_inch=result.px_per_inch,
+        confidence=result.confidence,
+        error=abs(result.px_per_inch - expected_px_per_inch),
+        wall_time=wall_time,
+        peak_memory=peak_memory,
+        hough_calls=result.metrics.stages.get("hough_transform", scale_detection.StageTime()).calls,
+        stages=result.metrics.stages,
+        counters=result.metrics.counters,
+    )
+
+
+def print_result(result: BenchmarkResult, previous: Optional[Dict[str, Any]] = None):
+    line = (
+        f"{result.image:40} {result.config:14} {result.px_per_inch:8.2f} "
+        f"{result.expected_px_per_inch:7.1f} {'ok  ' if result.error <= 1 else 'FAIL'} "
+        f"{result.wall_time:7.3f}s {result.peak_memory / 2**20:7.1f}MB {result.hough_calls:3d}"
+    )
+    if previous is not None:
+        line += (
+            f"  time x{result.wall_time / previous['wall_time']:.2f}"
+            f"  error {previous['error']:.2f} -> {result.error:.2f}"
+        )
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--config",
+        action="append",
+        choices=list(configs),
+        help="detection settings to benchmark, default all",
+    )
+    parser.add_argument(
+        "--synthetic",
+        action="append",
+        metavar="WIDTHxHEIGHT:PX_PER_SQUARE",
+        help=f"synthetic grid to add, default {' '.join(default_synthetic)}",
+    )
+    parser.add_argument("--no-test-images", action="store_true", help="skip tests/images")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per image, fastest counts")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare with")
+    args = parser.parse_args()
+
+    images: List[Tuple[str, str, float]] = []
+    if not args.no_test_images:
+        for filename, expected_scale in expected_scales:
+            images.append((filename, str(images_path / filename), float(expected_scale)))
+
+    previous: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    if args.compare:
+        with open(args.compare) as f:
+            for item in json.load(f)["results"]:
+                previous[(item["image"], item["config"])] = item
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for i, value in enumerate(args.synthetic or default_synthetic):
+            width, height, px_per_square = parse_synthetic(value)
+            path = os.path.join(tmp_dir, f"synthetic_{i}.png")
+            cv2.imwrite(path, synthetic_grid(width, height, px_per_square, seed=i))
+            images.append((f"synthetic {value}", path, px_per_square))
+
+        print(
+            f"{'image':40} {'config':14} {'result':>8} {'expected':>7} ok   time     memory  hough"
+        )
+        for name, path, expected_px_per_inch in images:
+            for config_name in args.config or list(configs):
+                result = benchmark_image(
+                    name, path, expected_px_per_inch, config_name, repeat=args.repeat
+                )
+                print_result(result, previous.get((name, config_name)))
+                results.append(result)
+
+    failed = sum(result.error > 1 for result in results)
+    print(f"{len(results) - failed}/{len(results)} within 1 px of the expected value")
+
+    if args.output:
+        data = {
+            "detector_version": scale_detection.detector_version,
+            "python": sys.version,
+            "opencv": cv2.__version__,
+            "numpy": np.__version__,
+            "machine": platform.platform(),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "results": [asdict(result) for result in results],
+        }
+        with open(args.output, "w") as f:
+            json.dump(data, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
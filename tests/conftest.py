@@ -0,0 +1,17 @@
+import pytest
+
+from battle_map_tv import storage, tiled_image
+
+
+@pytest.fixture(autouse=True)
+def storage_filepath(tmp_path, monkeypatch):
+    """Keep tests from writing to the config file of the user."""
+    filepath = tmp_path / "config.json"
+    monkeypatch.setattr(storage, "filepath", str(filepath))
+    return filepath
+
+
+@pytest.fixture
+def small_tiles(monkeypatch):
+    """Cut small images into several tiles."""
+    monkeypatch.setattr(tiled_image, "tile_size", 100)
@@ -0,0 +1,68 @@
+from pathlib import Path
+
+import cv2
+import pytest
+from PySide6.QtCore import QRect, QSize
+from PySide6.QtGui import QImage
+
+from battle_map_tv.image import (
+    CustomGraphicsPixmapItem,
+    _detect_file_region_scale,
+    _detect_qimage_region_scale,
+    read_image,
+    read_preview,
+)
+from tests.test_scale_detection import grid_image
+
+images_path = Path(__file__).parent / "images"
+
+
+@pytest.mark.parametrize("x, y", [(600, 0), (1000, 200), (1200, 400)])
+def test_detect_qimage_region_scale(x, y):
+    image = grid_image()[y : y + 600, x : x + 600].copy()
+    height, width = image.shape[:2]
+    qimage = QImage(image.data, width, height, image.strides[0], QImage.Format.Format_BGR888)
+    result = _detect_qimage_region_scale(qimage, offset=(x, y))
+    assert abs(result.px_per_inch - 50) <= 1
+    # the phase is in pixels of the whole image
+    assert result.phase_x == pytest.approx(23, abs=2)
+    assert result.phase_y == pytest.approx(37, abs=2)
+    assert all(x <= rho < x + width for rho in result.rhos_vertical)
+
+
+def test_detect_file_region_scale(tmp_path):
+    filepath = str(tmp_path / "grid.png")
+    cv2.imwrite(filepath, grid_image())
+    result = _detect_file_region_scale(filepath, QRect(1000, 200, 600, 600))
+    assert abs(result.px_per_inch - 50) <= 1
+    assert result.phase_x == pytest.approx(23, abs=2)
+    assert result.phase_y == pytest.approx(37, abs=2)
+
+
+def test_read_preview():
+    preview = read_preview(str(images_path / "7b1071f5cddcfa565d89dbdce45b9e39.jpg"))
+    assert preview.size() == QSize(1024, 726)
+
+
+@pytest.mark.parametrize(
+    "image_filename",
+    ["7b1071f5cddcfa565d89dbdce45b9e39.jpg", "19d33097089ed961c4660b3a0bf671e1.png"],
+)
+def test_read_image_size(image_filename):
+    image = read_image(str(images_path / image_filename), size=QSize(300, 200))
+    assert image.size() == QSize(300, 200)
+
+
+def test_read_image_unreadable(tmp_path):
+    filepath = tmp_path / "broken.png"
+    filepath.write_bytes(b"not a png")
+    with pytest.raises(ValueError):
+        read_image(str(filepath))
+
+
+def test_custom_graphics_pixmap_item_size_before_read():
+    item = CustomGraphicsPixmapItem(str(images_path / "19d33097089ed961c4660b3a0bf671e1.png"))
+    # the image is read in the background, but the item has its size already
+    assert item.is_preview()
+    assert (item.width(), item.height()) == (1000, 687)
+    item.cancel_loading()
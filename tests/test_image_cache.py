@@ -0,0 +1,114 @@
+import os
+
+import pytest
+from PySide6.QtCore import QThreadPool
+from PySide6.QtGui import QImage
+
+from battle_map_tv.image_cache import (
+    ImageCache,
+    estimated_size,
+    levels_size,
+    neighbours,
+    read_levels,
+)
+from battle_map_tv.tiled_image import build_level
+
+
+def levels(width: int = 100, height: int = 100):
+    image = QImage(width, height, QImage.Format.Format_RGB32)
+    image.fill(0)
+    return [build_level(image)]
+
+
+@pytest.fixture
+def maps_path(tmp_path):
+    for filename in ["a.png", "b.jpg", "c.PNG", "d.png", "notes.txt"]:
+        (tmp_path / filename).write_bytes(b"")
+    return tmp_path
+
+
+@pytest.mark.parametrize(
+    "filename, expected",
+    [
+        ("a.png", ["b.jpg"]),
+        ("b.jpg", ["a.png", "c.PNG"]),
+        ("d.png", ["c.PNG"]),
+        ("notes.txt", []),
+    ],
+)
+def test_neighbours(maps_path, filename, expected):
+    result = neighbours(str(maps_path / filename))
+    assert result == [str(maps_path / f) for f in expected]
+
+
+def test_image_cache_lru(maps_path):
+    cache = ImageCache(budget=2 * levels_size(levels()))
+    cache.put(str(maps_path / "a.png"), levels())
+    cache.put(str(maps_path / "b.jpg"), levels())
+    cache.put(str(maps_path / "c.PNG"), levels())
+    assert cache.pop(str(maps_path / "a.png")) is None
+    assert cache.pop(str(maps_path / "b.jpg")) is not None
+    # taken out of the cache while it's shown
+    assert cache.pop(str(maps_path / "b.jpg")) is None
+    assert cache.size() == levels_size(levels())
+
+
+def test_image_cache_too_big(maps_path):
+    cache = ImageCache(budget=levels_size(levels()))
+    cache.put(str(maps_path / "a.png"), levels(200, 100))
+    assert cache.pop(str(maps_path / "a.png")) is None
+
+
+def test_image_cache_file_changed(maps_path):
+    cache = ImageCache()
+    cache.put(str(maps_path / "a.png"), levels())
+    stat = os.stat(maps_path / "a.png")
+    os.utime(maps_path / "a.png", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert cache.pop(str(maps_path / "a.png")) is None
+
+
+def test_read_levels(tmp_path, small_tiles):
+    image = QImage(450, 230, QImage.Format.Format_RGB32)
+    image.fill(0)
+    image.save(str(tmp_path / "map.png"))
+    result = read_levels(str(tmp_path / "map.png"))
+    assert [(level.width, level.height) for level in result] == [
+        (450, 230),
+        (225, 115),
+        (113, 58),
+        (57, 29),
+    ]
+
+
+def test_estimated_size(tmp_path):
+    image = QImage(450, 230, QImage.Format.Format_RGB32)
+    image.fill(0)
+    image.save(str(tmp_path / "map.png"))
+    (tmp_path / "empty.png").write_bytes(b"")
+    assert estimated_size(str(tmp_path / "map.png")) == 450 * 230 * 4 * 4 // 3
+    assert estimated_size(str(tmp_path / "empty.png")) is None
+
+
+def test_prefetch_too_big(tmp_path):
+    image = QImage(450, 230, QImage.Format.Format_RGB32)
+    image.fill(0)
+    for filename in ["a.png", "b.png"]:
+        image.save(str(tmp_path / filename))
+    cache = ImageCache(budget=450 * 230 * 4)
+    cache.prefetch(str(tmp_path / "a.png"))
+    assert cache._prefetch_workers == {}
+
+
+def test_cancel_prefetch(tmp_path):
+    image = QImage(450, 230, QImage.Format.Format_RGB32)
+    image.fill(0)
+    for filename in ["a.png", "b.png"]:
+        image.save(str(tmp_path / filename))
+    cache = ImageCache()
+    cache.prefetch(str(tmp_path / "a.png"))
+    workers = list(cache._prefetch_workers.values())
+    assert len(workers) == 1
+    cache.cancel_prefetch()
+    QThreadPool.globalInstance().waitForDone()
+    assert cache._prefetch_workers == {}
+    assert workers[0].is_cancelled()
@@ -0,0 +1,81 @@
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from battle_map_tv import package, tiled_image
+from battle_map_tv.image import read_image
+from battle_map_tv.storage import ImageKeys, get_image_from_storage, set_image_in_storage
+from battle_map_tv.utils import qimage_to_array
+
+images_path = Path(__file__).parent / "images"
+
+
+pytestmark = pytest.mark.usefixtures("small_tiles")
+
+
+@pytest.fixture
+def maps_path(tmp_path):
+    maps_path = tmp_path / "maps"
+    (maps_path / "sub").mkdir(parents=True)
+    shutil.copy(images_path / "19d33097089ed961c4660b3a0bf671e1.png", maps_path / "a.png")
+    shutil.copy(images_path / "7b1071f5cddcfa565d89dbdce45b9e39.jpg", maps_path / "sub" / "b.jpg")
+    return maps_path
+
+
+def test_read_package(maps_path, monkeypatch):
+    monkeypatch.setattr(package, "thumbnail_size", 50)
+    image_path = str(maps_path / "a.png")
+    package_path = str(maps_path / "a.bmtv")
+    set_image_in_storage("a.png", ImageKeys.px_per_inch, 50.0)
+    package.convert_image(image_path, package_path)
+
+    result = package.read_package(package_path)
+    image = read_image(image_path)
+    levels = result.levels
+    assert (levels[0].width, levels[0].height) == (image.width(), image.height())
+    assert levels[-1].width <= 100 and levels[-1].height <= 100
+    region = tiled_image.level_region(levels[0], image.rect())
+    assert np.array_equal(region, qimage_to_array(image.convertToFormat(levels[0].format)))
+    assert max(result.thumbnail.width(), result.thumbnail.height()) == 50
+    assert result.settings == {"px_per_inch": 50.0}
+    assert result.source_hash == package.image_hash(image_path)
+
+
+def test_tiles_are_aligned(maps_path):
+    package_path = str(maps_path / "a.bmtv")
+    package.convert_image(str(maps_path / "a.png"), package_path)
+    header = package._read_header(package_path)
+    offsets = [entry["offset"] for entry in package._image_entries(header)]
+    assert offsets == sorted(offsets)
+    assert all(offset % package.alignment == 0 for offset in offsets)
+
+
+@pytest.mark.parametrize(
+    "content", [b"", b"not a package", b"BMTV\x02\x00\x00\x00\x00\x00\x00\x00"]
+)
+def test_read_package_invalid(tmp_path, content):
+    package_path = tmp_path / "a.bmtv"
+    package_path.write_bytes(content)
+    with pytest.raises((ValueError, package.struct.error)):
+        package.read_package(str(package_path))
+
+
+def test_settings_to_storage():
+    set_image_in_storage("a.bmtv", ImageKeys.scale, 0.5)
+    package.settings_to_storage("a.bmtv", {"scale": 2.0, "rotation": 90})
+    assert get_image_from_storage("a.bmtv", ImageKeys.scale) == 0.5
+    assert get_image_from_storage("a.bmtv", ImageKeys.rotation) == 90
+
+
+def test_convert_directory(maps_path, tmp_path):
+    output_path = tmp_path / "packages"
+    package_paths = package.convert_directory(str(maps_path), output_directory=str(output_path))
+    assert package_paths == [str(output_path / "a.bmtv"), str(output_path / "sub" / "b.bmtv")]
+    modified = [Path(path).stat().st_mtime_ns for path in package_paths]
+
+    shutil.copy(images_path / "58fed75f78a991251930918a5793051d.jpg", maps_path / "sub" / "b.jpg")
+    package.convert_directory(str(maps_path), output_directory=str(output_path))
+    assert Path(package_paths[0]).stat().st_mtime_ns == modified[0]
+    assert Path(package_paths[1]).stat().st_mtime_ns != modified[1]
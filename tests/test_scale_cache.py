@@ -0,0 +1,101 @@
+import os
+import shutil
+from pathlib import Path
+
+import cv2
+import pytest
+
+from battle_map_tv import scale_cache
+from battle_map_tv.scale_detection import ScaleDetectionResult
+from tests.test_scale_detection import gridless_image
+
+image_path = Path(__file__).parent / "images" / "19d33097089ed961c4660b3a0bf671e1.png"
+
+
+@pytest.fixture(autouse=True)
+def cache_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(scale_cache, "path", str(tmp_path))
+    return tmp_path
+
+
+def test_image_hash_depends_on_content(tmp_path):
+    copy_path = tmp_path / "copy.png"
+    shutil.copy(image_path, copy_path)
+    assert scale_cache.image_hash(str(copy_path)) == scale_cache.image_hash(str(image_path))
+    with open(copy_path, "ab") as f:
+        f.write(b"\0")
+    assert scale_cache.image_hash(str(copy_path)) != scale_cache.image_hash(str(image_path))
+
+
+def test_detect_image_scale_cached(monkeypatch):
+    result = scale_cache.detect_image_scale_cached(str(image_path))
+    assert result.px_per_inch == pytest.approx(45, abs=1)
+    assert result.metrics is not None
+
+    def fail(*args, **kwargs):
+        raise AssertionError("detection should not run again")
+
+    monkeypatch.setattr(scale_cache, "detect_image_scale", fail)
+    cached_result = scale_cache.detect_image_scale_cached(str(image_path))
+    assert cached_result == result
+    assert cached_result.metrics is None
+
+
+def test_evict_other_versions(cache_path):
+    stale_path = cache_path / "v0"
+    stale_path.mkdir()
+    (stale_path / "abc.json").write_text("{}")
+    scale_cache.set_in_cache("def", ScaleDetectionResult(10.0, 0.5, [], []))
+    assert not stale_path.exists()
+    assert scale_cache.get_from_cache("def") is not None
+
+
+def test_evict_least_recently_used(monkeypatch):
+    monkeypatch.setattr(scale_cache, "max_entries", 2)
+    for i, key in enumerate(["a", "b", "c"]):
+        scale_cache.set_in_cache(key, ScaleDetectionResult(float(i), 0.5, [], []))
+        os.utime(scale_cache._entry_path(key), (i, i))
+    scale_cache.evict()
+    assert scale_cache.get_from_cache("a") is None
+    assert scale_cache.get_from_cache("c") == ScaleDetectionResult(2.0, 0.5, [], [])
+
+
+def test_detect_image_scale_cached_incomplete():
+    result = scale_cache.detect_image_scale_cached(str(image_path), time_budget=0.0)
+    assert not result.complete
+    key = scale_cache.cache_key(str(image_path), pyramid=False, engine="hough")
+    assert scale_cache.get_from_cache(key) is None
+
+
+def test_detect_image_scale_cached_no_grid(tmp_path):
+    gridless_path = str(tmp_path / "gridless.png")
+    cv2.imwrite(gridless_path, gridless_image())
+    result = scale_cache.detect_image_scale_cached(gridless_path)
+    assert result.complete and not result.grid_found
+    key = scale_cache.cache_key(gridless_path, pyramid=False, engine="hough")
+    assert scale_cache.get_from_cache(key) is None
+
+
+def test_detect_image_scale_cached_decoded_image(monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("the image should not be decoded again")
+
+    monkeypatch.setattr(scale_cache, "detect_image_scale", fail)
+    image = cv2.imread(str(image_path))
+    result = scale_cache.detect_image_scale_cached(str(image_path), image=image)
+    assert result.px_per_inch == pytest.approx(45, abs=1)
+    assert scale_cache.detect_image_scale_cached(str(image_path)) == result
+
+
+def test_detect_image_scale_cached_image_function(monkeypatch):
+    calls = []
+
+    def read_pixels():
+        calls.append(1)
+        return cv2.imread(str(image_path))
+
+    result = scale_cache.detect_image_scale_cached(str(image_path), image=read_pixels)
+    assert result.px_per_inch == pytest.approx(45, abs=1)
+    # the pixels aren't needed when the result is cached
+    assert scale_cache.detect_image_scale_cached(str(image_path), image=read_pixels) == result
+    assert len(calls) == 1
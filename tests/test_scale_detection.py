@@ -1,8 +1,32 @@
+import time
 from pathlib import Path
+from typing import List
 
+import cv2
+import numpy as np
 import pytest
 
-from battle_map_tv.scale_detection import merge_close_together_lines, find_image_scale
+from battle_map_tv import scale_detection
+from battle_map_tv.scale_detection import (
+    DetectionMetrics,
+    merge_close_together_lines,
+    detect_array_scale,
+    detect_image_scale,
+    find_image_scale,
+    grid_phase,
+    image_to_edges,
+    is_periodic,
+    HoughAccumulator,
+    keep_only_lines_with_certain_orientation,
+    merge_tile_results,
+    optimization,
+    ScaleDetectionResult,
+    SearchHint,
+    theta_horizontal,
+    tile_positions,
+)
+
+images_path = Path(__file__).parent / "images"
 
 
 def test_merge_close_together_lines():
@@ -12,23 +36,319 @@ def test_merge_close_together_lines():
     assert result == pytest.approx(expected, abs=0.001)
 
 
-@pytest.mark.parametrize(
-    "image_filename, expected_px_per_inch",
-    [
-        ("19d33097089ed961c4660b3a0bf671e1.png", 45),
-        ("27995b4c0d372367142ddf0ead558bac.png", 24),
-        ("f46702b17442d0be4acc06cb7aa25ab8.jpg", 34),
-        ("67ce2ff0f7dfbff87d767d2c3da67662.jpg", 35),
-        ("6932a173690af4b593f8a6b52df3bd31.jpg", 72),
-        ("675a18475269c17cfa20c980e7c05ea0.jpg", 100),
-        ("58fed75f78a991251930918a5793051d.jpg", 70),
-        ("7b1071f5cddcfa565d89dbdce45b9e39.jpg", 50),
-        ("e586d099df4e4c0eb82726f6373d964f.jpg", 72),
-        ("pux2idlwle65yipahqnmukisnss54cyv.jpg", 73),
-    ],
-)
+@pytest.mark.parametrize("threshold", [50, 150, 300])
+def test_hough_accumulator_same_as_hough_lines(threshold):
+    image = cv2.imread(str(images_path / "19d33097089ed961c4660b3a0bf671e1.png"))
+    edges = image_to_edges(image)
+    expected = cv2.HoughLines(edges, rho=1, theta=np.pi / 180, threshold=threshold)
+    result = HoughAccumulator(edges).lines(threshold=threshold)
+    assert sorted(result) == sorted(tuple(line[0]) for line in expected.tolist())
+
+
+@pytest.mark.parametrize("wanted_theta", [0, np.pi / 2])
+def test_hough_accumulator_wanted_theta(wanted_theta):
+    image = cv2.imread(str(images_path / "7b1071f5cddcfa565d89dbdce45b9e39.jpg"))
+    edges = image_to_edges(image)
+    expected = keep_only_lines_with_certain_orientation(
+        lines=HoughAccumulator(edges).lines(threshold=100),
+        wanted_theta=wanted_theta,
+    )
+    result = keep_only_lines_with_certain_orientation(
+        lines=HoughAccumulator(edges, wanted_theta=wanted_theta).lines(threshold=100),
+        wanted_theta=wanted_theta,
+    )
+    assert len(result) > 0
+    assert result == expected
+
+
+expected_scales = [
+    ("19d33097089ed961c4660b3a0bf671e1.png", 45),
+    ("27995b4c0d372367142ddf0ead558bac.png", 24),
+    ("f46702b17442d0be4acc06cb7aa25ab8.jpg", 34),
+    ("67ce2ff0f7dfbff87d767d2c3da67662.jpg", 35),
+    ("6932a173690af4b593f8a6b52df3bd31.jpg", 72),
+    ("675a18475269c17cfa20c980e7c05ea0.jpg", 100),
+    ("58fed75f78a991251930918a5793051d.jpg", 70),
+    ("7b1071f5cddcfa565d89dbdce45b9e39.jpg", 50),
+    ("e586d099df4e4c0eb82726f6373d964f.jpg", 72),
+    ("pux2idlwle65yipahqnmukisnss54cyv.jpg", 73),
+]
+
+
+@pytest.mark.parametrize("image_filename, expected_px_per_inch", expected_scales)
 def test_addition(image_filename, expected_px_per_inch):
-    filepath = Path(__file__).parent / "images" / image_filename
+    filepath = images_path / image_filename
     assert filepath.exists()
     px_per_inch = find_image_scale(str(filepath))
     assert abs(px_per_inch - expected_px_per_inch) <= 1
+
+
+@pytest.mark.parametrize("image_filename, expected_px_per_inch", expected_scales)
+def test_find_image_scale_pyramid(image_filename, expected_px_per_inch):
+    px_per_inch = find_image_scale(str(images_path / image_filename), pyramid=True)
+    assert abs(px_per_inch - expected_px_per_inch) <= 1
+
+
+@pytest.mark.parametrize("engine", ["projection", "auto"])
+@pytest.mark.parametrize("image_filename, expected_px_per_inch", expected_scales)
+def test_find_image_scale_engine(image_filename, expected_px_per_inch, engine):
+    px_per_inch = find_image_scale(str(images_path / image_filename), engine=engine)
+    assert abs(px_per_inch - expected_px_per_inch) <= 1
+
+
+def test_find_image_scale_unknown_engine():
+    with pytest.raises(ValueError):
+        find_image_scale(str(images_path / expected_scales[0][0]), engine="unknown")
+
+
+def test_optimization_deadline():
+    edges = image_to_edges(cv2.imread(str(images_path / "7b1071f5cddcfa565d89dbdce45b9e39.jpg")))
+    steps: List[float] = []
+    px_per_inch, confidence, rhos = optimization(
+        accumulator=HoughAccumulator(edges, wanted_theta=theta_horizontal),
+        wanted_theta=theta_horizontal,
+        image_length=edges.shape[1],
+        progress=steps.append,
+        deadline=time.monotonic(),
+    )
+    # only the first threshold is tried
+    assert len(steps) == 2
+    assert confidence == 0.0
+
+
+def test_optimization_max_steps(monkeypatch):
+    monkeypatch.setattr(scale_detection, "max_steps", 3)
+    edges = image_to_edges(cv2.imread(str(images_path / "7b1071f5cddcfa565d89dbdce45b9e39.jpg")))
+    steps: List[float] = []
+    optimization(
+        accumulator=HoughAccumulator(edges, wanted_theta=theta_horizontal),
+        wanted_theta=theta_horizontal,
+        image_length=edges.shape[1],
+        progress=steps.append,
+    )
+    assert steps == [pytest.approx(1 / 3), pytest.approx(2 / 3), 1.0, 1.0]
+
+
+def _optimization_steps(image_filename: str, hint=None):
+    edges = image_to_edges(cv2.imread(str(images_path / image_filename)))
+    metrics = DetectionMetrics()
+    px_per_inch, confidence, rhos = optimization(
+        accumulator=HoughAccumulator(edges, wanted_theta=theta_horizontal),
+        wanted_theta=theta_horizontal,
+        image_length=edges.shape[1],
+        metrics=metrics,
+        hint=hint,
+    )
+    return px_per_inch, metrics
+
+
+# on these images the grid is found with a confidence above hint_min_confidence
+@pytest.mark.parametrize("image_filename, expected_px_per_inch", expected_scales[3:])
+def test_optimization_hint(image_filename, expected_px_per_inch):
+    px_per_inch, metrics = _optimization_steps(image_filename)
+    assert len(metrics.line_coverage) == 1
+    coverage = metrics.line_coverage[0]
+    hint = SearchHint(coverage=coverage, low=coverage / 1.25, high=coverage * 1.25)
+    px_per_inch_hinted, metrics_hinted = _optimization_steps(image_filename, hint=hint)
+    assert abs(px_per_inch_hinted - expected_px_per_inch) <= 1
+    steps = metrics.counters["horizontal_threshold_steps"]
+    assert metrics_hinted.counters["horizontal_threshold_steps"] < steps
+
+
+def test_optimization_bad_hint():
+    image_filename, expected_px_per_inch = expected_scales[0]
+    # no lines have this many votes, so the full search runs
+    hint = SearchHint(coverage=10.0, low=10.0, high=10.0)
+    px_per_inch, _ = _optimization_steps(image_filename, hint=hint)
+    assert abs(px_per_inch - expected_px_per_inch) <= 1
+
+
+def test_detect_image_scale_time_budget():
+    filepath = str(images_path / "7b1071f5cddcfa565d89dbdce45b9e39.jpg")
+    result = detect_image_scale(filepath, time_budget=0.0)
+    assert not result.complete
+    result = detect_image_scale(filepath, time_budget=60.0)
+    assert result.complete
+    assert abs(result.px_per_inch - 50) <= 1
+
+
+@pytest.mark.parametrize(
+    "engine, pyramid, stages",
+    [
+        ("hough", False, {"decode", "canny", "periodicity", "hough_transform", "hough_lines"}),
+        ("hough", True, {"downsample", "hough_transform", "refine"}),
+        ("projection", False, {"decode", "canny", "projection"}),
+    ],
+)
+def test_detect_image_scale_metrics(engine, pyramid, stages):
+    filepath = str(images_path / "7b1071f5cddcfa565d89dbdce45b9e39.jpg")
+    result = detect_image_scale(filepath, engine=engine, pyramid=pyramid)
+    metrics = result.metrics
+    assert metrics is not None
+    assert stages <= metrics.stages.keys()
+    assert metrics.stages["decode"].calls == 1
+    assert 0 < sum(stage.seconds for stage in metrics.stages.values())
+    assert 0 < metrics.stages["decode"].seconds < metrics.total_seconds
+    if engine == "hough":
+        assert metrics.stages["hough_transform"].calls == 2
+        assert metrics.counters["horizontal_threshold_steps"] > 0
+        assert metrics.counters["vertical_lines"] == len(result.rhos_vertical)
+
+
+@pytest.mark.parametrize("channels", [1, 3, 4])
+def test_detect_array_scale(channels):
+    filepath = str(images_path / "7b1071f5cddcfa565d89dbdce45b9e39.jpg")
+    image = cv2.imread(filepath)
+    assert image is not None
+    if channels == 1:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    elif channels == 4:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2BGRA)
+    image.flags.writeable = False
+    assert detect_array_scale(image) == detect_image_scale(filepath)
+
+
+def gridless_image(width: int = 2000, height: int = 1500, seed: int = 0) -> np.ndarray:
+    """Noise with room outlines and circles at random places."""
+    rng = np.random.default_rng(seed)
+    image = np.clip(180 + rng.normal(0, 10, (height, width, 1)), 0, 255).astype(np.uint8)
+    image = np.repeat(image, 3, axis=2)
+    for _ in range(25):
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        size = int(rng.integers(50, width // 2)), int(rng.integers(50, height // 2))
+        cv2.rectangle(image, (x, y), (x + size[0], y + size[1]), (40, 40, 40), 5)
+    for _ in range(30):
+        center = int(rng.integers(0, width)), int(rng.integers(0, height))
+        color = tuple(int(c) for c in rng.integers(0, 255, 3))
+        cv2.circle(image, center, int(rng.integers(10, 80)), color, -1)
+    return image
+
+
+@pytest.mark.parametrize("engine", ["hough", "projection", "auto"])
+@pytest.mark.parametrize("pyramid", [False, True])
+def test_detect_array_scale_no_grid(engine, pyramid, monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("the Hough transform should be skipped")
+
+    monkeypatch.setattr(scale_detection, "HoughAccumulator", fail)
+    result = detect_array_scale(gridless_image(), engine=engine, pyramid=pyramid)
+    assert not result.grid_found
+    assert result.confidence == 0.0
+
+
+@pytest.mark.parametrize("image_filename, expected_px_per_inch", expected_scales)
+def test_is_periodic(image_filename, expected_px_per_inch):
+    image = cv2.imread(str(images_path / image_filename))
+    assert is_periodic(image_to_edges(image))
+
+
+@pytest.mark.parametrize(
+    "rhos, expected",
+    [
+        ([10, 60, 110], 10.5),
+        ([10, 60, 160, 210], 10.5),
+        ([49.6, 99.4, 149.5], 0.0),
+        ([0, 12.5, 25, 37.5], None),
+        ([], None),
+    ],
+)
+def test_grid_phase(rhos, expected):
+    phase = grid_phase(rhos=rhos, px_per_inch=50)
+    if expected is None:
+        assert phase is None
+    else:
+        assert phase is not None
+        # the phase wraps around at the spacing
+        assert min(abs(phase - expected), 50 - abs(phase - expected)) < 0.1
+
+
+def grid_image(px_per_inch: float = 50) -> np.ndarray:
+    """Grid lines of 2 pixels wide and 50 pixels apart, the first centered on x 23 and y 37."""
+    image = gridless_image(seed=1)
+    for x in np.arange(23, image.shape[1], px_per_inch).round().astype(int):
+        cv2.line(image, (x, 0), (x, image.shape[0] - 1), (20, 20, 20), 2)
+    for y in np.arange(37, image.shape[0], px_per_inch).round().astype(int):
+        cv2.line(image, (0, y), (image.shape[1] - 1, y), (20, 20, 20), 2)
+    return image
+
+
+@pytest.mark.parametrize("pyramid", [False, True])
+def test_detect_array_scale_phase(pyramid):
+    result = detect_array_scale(grid_image(), pyramid=pyramid)
+    assert abs(result.px_per_inch - 50) <= 1
+    assert result.phase_x == pytest.approx(23, abs=2)
+    assert result.phase_y == pytest.approx(37, abs=2)
+
+
+@pytest.mark.parametrize("px_per_inch", [50.5, 60.5, 70.5])
+def test_detect_array_scale_fractional_spacing(px_per_inch):
+    # the lines are alternately a pixel closer and further apart
+    result = detect_array_scale(grid_image(px_per_inch), engine="auto")
+    assert result.px_per_inch == pytest.approx(px_per_inch, abs=1)
+
+
+def test_detect_array_scale_fractional_spacing_resized():
+    image = cv2.imread(str(images_path / "7b1071f5cddcfa565d89dbdce45b9e39.jpg"))
+    assert image is not None
+    image = cv2.resize(image, None, fx=1.01, fy=1.01, interpolation=cv2.INTER_AREA)
+    result = detect_array_scale(image, engine="projection")
+    assert result.px_per_inch == pytest.approx(50.5, abs=1)
+
+
+@pytest.mark.parametrize(
+    "image_filename, expected_px_per_inch, memory_cap",
+    [
+        # decoded in part
+        ("6932a173690af4b593f8a6b52df3bd31.jpg", 72, 16),
+        ("675a18475269c17cfa20c980e7c05ea0.jpg", 100, 4),
+        # decoded in grey
+        ("27995b4c0d372367142ddf0ead558bac.png", 24, 4),
+    ],
+)
+def test_detect_image_scale_memory_cap(image_filename, expected_px_per_inch, memory_cap):
+    filepath = str(images_path / image_filename)
+    result = detect_image_scale(filepath, memory_cap=memory_cap * 2**20)
+    assert result.metrics is not None
+    assert result.metrics.counters["tiles"] == 9
+    assert abs(result.px_per_inch - expected_px_per_inch) <= 1
+
+
+def test_detect_image_scale_memory_cap_not_needed():
+    filepath = str(images_path / "7b1071f5cddcfa565d89dbdce45b9e39.jpg")
+    result = detect_image_scale(filepath, memory_cap=2**30)
+    assert result == detect_image_scale(filepath)
+    assert result.metrics is not None
+    assert "tiles" not in result.metrics.counters
+
+
+@pytest.mark.parametrize(
+    "width, height, size, n, expected",
+    [
+        (3000, 2000, 1000, 9, [(x, y) for y in (0, 500, 1000) for x in (0, 1000, 2000)]),
+        (1000, 3000, 1000, 9, [(0, 0), (0, 1000), (0, 2000)]),
+        (1000, 1000, 1000, 9, [(0, 0)]),
+        (3000, 3000, 1000, 2, [(0, 0), (2000, 2000)]),
+    ],
+)
+def test_tile_positions(width, height, size, n, expected):
+    assert tile_positions(width=width, height=height, size=size, n=n) == expected
+
+
+def test_merge_tile_results():
+    tile_results = [
+        (0, 0, ScaleDetectionResult(50.0, 0.9, [10.0, 60.0], [20.0, 70.0])),
+        (1000, 500, ScaleDetectionResult(51.0, 0.3, [20.0, 71.0], [30.0, 81.0])),
+        # the artwork of this tile has a different spacing
+        (0, 500, ScaleDetectionResult(30.0, 0.9, [], [])),
+        (1000, 0, ScaleDetectionResult(10.0, 0.0, [], [])),
+    ]
+    result = merge_tile_results(tile_results, n_tiles=5, factor=2)
+    assert result.px_per_inch == pytest.approx(2 * 50.25)
+    assert result.confidence == pytest.approx(1.2 / 5)
+    assert result.rhos_horizontal == [20.0, 120.0, 1040.0, 1142.0]
+    assert result.rhos_vertical == [40.0, 140.0, 2060.0, 2162.0]
+
+
+def test_merge_tile_results_no_grid():
+    result = merge_tile_results([(0, 0, ScaleDetectionResult(10.0, 0.0, [], []))], n_tiles=1)
+    assert not result.grid_found
@@ -0,0 +1,71 @@
+import shutil
+from pathlib import Path
+
+import cv2
+import pytest
+
+from battle_map_tv import scan
+from battle_map_tv.storage import ImageKeys, get_images_from_storage, set_image_in_storage
+from tests.test_scale_detection import gridless_image
+
+images_path = Path(__file__).parent / "images"
+
+
+@pytest.fixture
+def maps_path(tmp_path):
+    maps_path = tmp_path / "maps"
+    (maps_path / "sub").mkdir(parents=True)
+    shutil.copy(images_path / "19d33097089ed961c4660b3a0bf671e1.png", maps_path / "a.png")
+    shutil.copy(images_path / "7b1071f5cddcfa565d89dbdce45b9e39.jpg", maps_path / "sub" / "b.JPG")
+    (maps_path / "notes.txt").write_text("not an image")
+    return maps_path
+
+
+def test_find_images(maps_path):
+    assert scan.find_images(str(maps_path)) == [
+        str(maps_path / "a.png"),
+        str(maps_path / "sub" / "b.JPG"),
+    ]
+
+
+def test_scan_directory(maps_path):
+    results = scan.scan_directory(str(maps_path), processes=1)
+    assert results.keys() == {"a.png", "b.JPG"}
+    assert results["a.png"] == pytest.approx(45, abs=1)
+    assert get_images_from_storage(ImageKeys.px_per_inch) == results
+    assert get_images_from_storage(ImageKeys.grid_phase).keys() == results.keys()
+
+
+def test_scan_directory_skips_scanned_images(maps_path):
+    set_image_in_storage("a.png", ImageKeys.px_per_inch, 10.0)
+    set_image_in_storage("a.png", ImageKeys.rotation, 90)
+    results = scan.scan_directory(str(maps_path), processes=1)
+    assert results.keys() == {"b.JPG"}
+    stored = get_images_from_storage(ImageKeys.px_per_inch)
+    assert stored["a.png"] == 10.0
+    assert get_images_from_storage(ImageKeys.rotation) == {"a.png": 90}
+
+    results = scan.scan_directory(str(maps_path), processes=1, rescan=True)
+    assert results.keys() == {"a.png", "b.JPG"}
+    assert get_images_from_storage(ImageKeys.px_per_inch)["a.png"] == pytest.approx(45, abs=1)
+
+
+def test_scan_directory_unreadable_image(maps_path):
+    (maps_path / "broken.png").write_bytes(b"not a png")
+    results = scan.scan_directory(str(maps_path), processes=1)
+    assert "broken.png" not in results
+    assert "broken.png" not in get_images_from_storage(ImageKeys.px_per_inch)
+
+
+def test_scan_directory_no_grid(maps_path):
+    cv2.imwrite(str(maps_path / "gridless.png"), gridless_image())
+    results = scan.scan_directory(str(maps_path), processes=1)
+    assert results["gridless.png"] is None
+    assert get_images_from_storage(ImageKeys.px_per_inch)["gridless.png"] is None
+    assert scan.scan_directory(str(maps_path), processes=1) == {}
+
+
+def test_scan_directory_memory_cap(maps_path):
+    results = scan.scan_directory(str(maps_path), processes=1, memory_cap=4 * 2**20)
+    assert results["a.png"] == pytest.approx(45, abs=1)
+    assert results["b.JPG"] == pytest.approx(50, abs=1)
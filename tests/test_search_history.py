@@ -0,0 +1,47 @@
+import pytest
+
+from battle_map_tv import search_history
+from battle_map_tv.scale_detection import DetectionMetrics, ScaleDetectionResult
+from battle_map_tv.search_history import add_to_search_history, get_search_hint
+
+
+def result(coverages, confidence=0.9, metrics=True) -> ScaleDetectionResult:
+    return ScaleDetectionResult(
+        px_per_inch=50.0,
+        confidence=confidence,
+        rhos_horizontal=[],
+        rhos_vertical=[],
+        metrics=DetectionMetrics(line_coverage=coverages) if metrics else None,
+    )
+
+
+def test_get_search_hint():
+    assert get_search_hint() is None
+    add_to_search_history([result([0.1, 0.2]), result([0.3, 0.4])])
+    assert get_search_hint() is None
+    add_to_search_history([result([0.5, 0.6])])
+    hint = get_search_hint()
+    assert hint is not None
+    assert hint.coverage == pytest.approx(0.35)
+    assert hint.low == pytest.approx(0.15)
+    assert hint.high == pytest.approx(0.55)
+
+
+def test_add_to_search_history_skips_results():
+    add_to_search_history(
+        [
+            result([0.1] * 10, confidence=0.0),
+            result([0.1] * 10, metrics=False),
+        ]
+    )
+    assert get_search_hint() is None
+
+
+def test_add_to_search_history_max_entries(monkeypatch):
+    monkeypatch.setattr(search_history, "max_entries", 6)
+    add_to_search_history([result([1.0] * 6)])
+    add_to_search_history([result([0.5] * 3)])
+    hint = get_search_hint()
+    assert hint is not None
+    assert hint.low == 0.5
+    assert hint.high == 1.0
@@ -0,0 +1,163 @@
+import cv2
+import numpy as np
+import pytest
+from PySide6.QtCore import QRect, QRectF, QSize
+from PySide6.QtGui import QColor, QImage, QPainter, QTransform
+from PySide6.QtWidgets import QStyleOptionGraphicsItem
+
+from battle_map_tv.tiled_image import (
+    TiledImageItem,
+    build_level,
+    build_pyramid,
+    choose_level,
+    level_region,
+    quarter_turns,
+    rotate_levels,
+    tiles_in_rect,
+)
+from battle_map_tv.utils import qimage_to_array
+
+
+pytestmark = pytest.mark.usefixtures("small_tiles")
+
+
+def random_image(width: int, height: int) -> QImage:
+    array = np.random.default_rng(0).integers(0, 256, (height, width, 4), dtype=np.uint8)
+    image = QImage(array.data, width, height, array.strides[0], QImage.Format.Format_RGB32)
+    return image.copy()
+
+
+@pytest.mark.parametrize(
+    "width, height, expected",
+    [
+        (100, 80, [(100, 80)]),
+        (101, 80, [(101, 80), (51, 40)]),
+        (450, 230, [(450, 230), (225, 115), (113, 58), (57, 29)]),
+    ],
+)
+def test_build_pyramid(width, height, expected):
+    level = build_level(random_image(width, height))
+    levels = [level] + build_pyramid(level)
+    assert [(level.width, level.height) for level in levels] == expected
+    for level in levels:
+        assert sum(tile.width() for tile in level.tiles[0]) == level.width
+        assert sum(row[0].height() for row in level.tiles) == level.height
+
+
+def test_build_pyramid_same_as_resize():
+    image = random_image(400, 200)
+    level = build_pyramid(build_level(image))[0]
+    expected = cv2.resize(qimage_to_array(image), (200, 100), interpolation=cv2.INTER_AREA)
+    for row, tiles in enumerate(level.tiles):
+        for col, tile in enumerate(tiles):
+            block = expected[row * 100 : (row + 1) * 100, col * 100 : (col + 1) * 100]
+            assert np.array_equal(qimage_to_array(tile), block)
+
+
+@pytest.mark.parametrize(
+    "level_of_detail, expected",
+    [(2.0, 0), (1.0, 0), (0.6, 0), (0.5, 1), (0.3, 1), (0.25, 2), (0.01, 3), (0.0, 3)],
+)
+def test_choose_level(level_of_detail, expected):
+    assert choose_level(level_of_detail, n_levels=4) == expected
+
+
+@pytest.mark.parametrize(
+    "level_of_detail, expected", [(1.0, 400), (0.2, 400), (0.15, 400), (0.1, 200), (0.05, 100)]
+)
+def test_item_choose_level_display_resolution(level_of_detail, expected):
+    # read at a fifth of the size of the image, like with --display-resolution
+    level = build_level(random_image(400, 200))
+    item = TiledImageItem(QImage())
+    item.set_levels([level] + build_pyramid(level), size=QSize(2000, 1000))
+    assert item.choose_level(level_of_detail, item.levels).width == expected
+    rotated = rotate_levels(item.levels, 1)
+    assert item.choose_level(level_of_detail, rotated).height == expected
+
+
+def test_tiles_in_rect():
+    level = build_level(random_image(450, 230))
+    rects = [rect for rect, _ in tiles_in_rect(level, QRectF(150, 50, 100, 60))]
+    assert rects == [
+        QRect(100, 0, 100, 100),
+        QRect(200, 0, 100, 100),
+        QRect(100, 100, 100, 100),
+        QRect(200, 100, 100, 100),
+    ]
+    rects = [rect for rect, _ in tiles_in_rect(level, QRectF(-50, 150, 1000, 1000))]
+    assert rects[-1] == QRect(400, 200, 50, 30)
+    assert len(rects) == 10
+
+
+@pytest.mark.parametrize("grey", [False, True])
+def test_level_region(grey):
+    image = random_image(450, 230)
+    rect = QRect(30, 40, 250, 150)
+    result = level_region(build_level(image), rect, grey=grey)
+    expected = qimage_to_array(image)[40:190, 30:280]
+    if grey:
+        expected = cv2.cvtColor(expected, cv2.COLOR_BGRA2GRAY)
+    assert np.array_equal(result, expected)
+
+
+@pytest.mark.parametrize("rect", [None, QRect(30, 40, 250, 150), QRect(400, 200, 100, 100)])
+def test_to_image(rect):
+    image = random_image(450, 230)
+    result = TiledImageItem(image).to_image(rect)
+    expected = image if rect is None else image.copy(rect.intersected(image.rect()))
+    assert result.size() == expected.size()
+    assert np.array_equal(qimage_to_array(result), qimage_to_array(expected))
+
+
+def test_preview():
+    item = TiledImageItem(random_image(45, 23), size=QSize(450, 230))
+    assert item.is_preview()
+    assert item.rect() == QRect(0, 0, 450, 230)
+    with pytest.raises(ValueError):
+        item.to_image()
+    item.set_image(random_image(450, 230))
+    assert not item.is_preview()
+
+
+@pytest.mark.parametrize("turns", [0, 1])
+def test_paint_placeholder(turns):
+    # the size of an image that isn't read yet
+    item = TiledImageItem(QImage(), size=QSize(450, 230))
+    assert item.choose_level(0.5, item.levels) is item.levels[0]
+    target = QImage(100, 100, QImage.Format.Format_RGB32)
+    target.fill(0)
+    painter = QPainter(target)
+    painter.scale(0.2, 0.2)
+    painter.rotate(90 * turns)
+    option = QStyleOptionGraphicsItem()
+    option.exposedRect = item.boundingRect()
+    item.paint(painter, option)
+    painter.end()
+    assert target.pixel(50, 50) == QColor(0, 0, 0).rgb()
+
+
+@pytest.mark.parametrize("turns", [1, 2, 3])
+def test_rotate_levels(turns):
+    image = random_image(450, 230)
+    levels = [build_level(image)]
+    levels += build_pyramid(levels[0])
+    rotated = rotate_levels(levels, turns)
+    assert len(rotated) == len(levels)
+    for level, rotated_level in zip(levels, rotated):
+        expected = np.rot90(level_region(level, QRect(0, 0, level.width, level.height)), -turns)
+        result = level_region(rotated_level, QRect(0, 0, *expected.shape[1::-1]))
+        assert (rotated_level.width, rotated_level.height) == expected.shape[1::-1]
+        assert np.array_equal(result, expected)
+
+
+@pytest.mark.parametrize(
+    "rotation, scale, expected",
+    [(0, 1.0, 0), (90, 0.5, 1), (180, 2.0, 2), (270, 1.0, 3), (-90, 1.0, 3), (45, 1.0, None)],
+)
+def test_quarter_turns(rotation, scale, expected):
+    transform = QTransform().translate(10, 20).rotate(rotation).scale(scale, scale)
+    assert quarter_turns(transform) == expected
+
+
+def test_quarter_turns_mirrored():
+    assert quarter_turns(QTransform().scale(-1, 1)) is None
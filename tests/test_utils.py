@@ -0,0 +1,49 @@
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+from PySide6.QtGui import QImage
+
+from battle_map_tv.utils import qimage_to_array
+
+image_path = Path(__file__).parent / "images" / "7b1071f5cddcfa565d89dbdce45b9e39.jpg"
+
+
+@pytest.mark.parametrize(
+    "image_format",
+    [
+        QImage.Format.Format_RGB32,
+        QImage.Format.Format_ARGB32,
+        QImage.Format.Format_ARGB32_Premultiplied,
+    ],
+)
+def test_qimage_to_array(image_format):
+    image = QImage(str(image_path)).convertToFormat(image_format)
+    array = qimage_to_array(image)
+    assert array.shape == (image.height(), image.width(), 4)
+    expected = cv2.imread(str(image_path))
+    assert expected is not None
+    assert np.array_equal(array[:, :, :3], expected)
+    assert not array.flags.writeable
+
+
+def test_qimage_to_array_grey():
+    # an odd width gives padding at the end of each line
+    image = QImage(str(image_path)).scaled(101, 50).convertToFormat(QImage.Format.Format_Grayscale8)
+    assert image.bytesPerLine() > image.width()
+    array = qimage_to_array(image)
+    assert array.shape == (50, 101)
+    assert array[10, 20] == image.pixelColor(20, 10).red()
+
+
+def test_qimage_to_array_shares_pixels():
+    image = QImage(str(image_path)).convertToFormat(QImage.Format.Format_RGB32)
+    copy = QImage(image)
+    assert np.shares_memory(qimage_to_array(image), qimage_to_array(copy))
+
+
+def test_qimage_to_array_unsupported_format():
+    image = QImage(str(image_path)).convertToFormat(QImage.Format.Format_RGB888)
+    with pytest.raises(ValueError):
+        qimage_to_array(image)
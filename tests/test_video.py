@@ -0,0 +1,101 @@
+from collections import deque
+
+import cv2
+import numpy as np
+import pytest
+from PySide6.QtCore import QCoreApplication, QThreadPool
+
+from battle_map_tv import video
+from battle_map_tv.tiled_image import level_region
+
+
+@pytest.fixture
+def video_path(tmp_path):
+    path = str(tmp_path / "loop.mp4")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter.fourcc(*"mp4v"), 10, (64, 48))
+    for i in range(5):
+        writer.write(np.full((48, 64, 3), i * 50, dtype=np.uint8))
+    writer.release()
+    return path
+
+
+@pytest.fixture
+def app():
+    """Deliver the signals of the workers with `app.processEvents()`."""
+    return QCoreApplication.instance() or QCoreApplication([])
+
+
+def brightness(level) -> int:
+    return round(level_region(level, level.tiles[0][0].rect())[..., :3].mean())
+
+
+@pytest.mark.parametrize(
+    "path, expected", [("a.mp4", True), ("a.WEBM", True), ("a.png", False), ("a.bmtv", False)]
+)
+def test_is_video(path, expected):
+    assert video.is_video(path) == expected
+
+
+@pytest.mark.parametrize("n_frames, expected", [(1, False), (3, True)])
+def test_is_video_gif(tmp_path, n_frames, expected):
+    path = str(tmp_path / "a.gif")
+    cv2.imwritemulti(path, [np.full((8, 8, 3), i * 50, dtype=np.uint8) for i in range(n_frames)])
+    assert video.is_video(path) == expected
+
+
+def test_open_video(video_path):
+    _, fps = video.open_video(video_path)
+    assert fps == 10
+
+
+def test_open_video_invalid(tmp_path):
+    path = tmp_path / "a.mp4"
+    path.write_bytes(b"not a video")
+    with pytest.raises(ValueError):
+        video.open_video(str(path))
+
+
+def test_decode_frames(video_path):
+    capture, _ = video.open_video(video_path)
+    buffer: deque = deque(maxlen=3)
+    video.decode_frames(capture, video_path, buffer)
+    assert [brightness(level) for level in buffer] == pytest.approx([0, 50, 100], abs=10)
+    buffer.popleft()
+    buffer.popleft()
+    video.decode_frames(capture, video_path, buffer)
+    assert [brightness(level) for level in buffer] == pytest.approx([100, 150, 200], abs=10)
+
+
+def test_decode_frames_loops(video_path):
+    capture, _ = video.open_video(video_path)
+    buffer: deque = deque(maxlen=7)
+    video.decode_frames(capture, video_path, buffer)
+    assert [brightness(level) for level in buffer][4:] == pytest.approx([200, 0, 50], abs=10)
+    assert (buffer[0].width, buffer[0].height) == (64, 48)
+
+
+@pytest.mark.parametrize("start", [False, True])
+def test_video_item_cancel_releases_capture(app, video_path, start):
+    item = video.VideoItem(video_path)
+    if start:
+        item.start_loading()
+    item.cancel_loading()
+    QThreadPool.globalInstance().waitForDone()
+    app.processEvents()
+    assert not item._capture.isOpened()
+
+
+def test_video_item_decode_error(app, video_path, monkeypatch, capsys):
+    item = video.VideoItem(video_path)
+
+    def broken_frame(*args):
+        raise ValueError("broken frame")
+
+    monkeypatch.setattr(video, "read_frame", broken_frame)
+    item.start_loading()
+    QThreadPool.globalInstance().waitForDone()
+    app.processEvents()
+    # the current frame stays, without decoding again on every tick
+    assert not item._timer.isActive()
+    assert item._decode_worker is None
+    assert "ValueError: broken frame" in capsys.readouterr().err
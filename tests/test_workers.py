@@ -0,0 +1,90 @@
+import threading
+from typing import Dict, List
+
+import pytest
+from PySide6.QtCore import QThreadPool
+
+from battle_map_tv.workers import Worker
+
+
+def run(worker: Worker) -> Dict[str, List]:
+    """Run the worker on this thread and record the signals it emits."""
+    emitted: Dict[str, List] = {"progress": [], "result": [], "cancelled": [], "finished": []}
+    worker.signals.progress.connect(emitted["progress"].append)
+    worker.signals.result.connect(emitted["result"].append)
+    worker.signals.cancelled.connect(lambda: emitted["cancelled"].append(None))
+    worker.signals.finished.connect(lambda: emitted["finished"].append(None))
+    worker.run()
+    return emitted
+
+
+def test_worker_result():
+    def fn(progress):
+        progress(0.5)
+        progress(1.0)
+        return 42
+
+    emitted = run(Worker(fn))
+    assert emitted["progress"] == [0.5, 1.0]
+    assert emitted["result"] == [42]
+    assert emitted["cancelled"] == []
+    assert len(emitted["finished"]) == 1
+
+
+def test_worker_cancelled_before_run():
+    calls = []
+
+    def fn(progress):
+        calls.append(1)
+        progress(0.5)
+        calls.append(2)
+
+    worker = Worker(fn)
+    worker.cancel()
+    emitted = run(worker)
+    # the first progress report stops the function
+    assert calls == [1]
+    assert emitted["result"] == []
+    assert len(emitted["cancelled"]) == 1
+    assert len(emitted["finished"]) == 1
+
+
+@pytest.mark.parametrize("report_progress", [True, False])
+def test_worker_cancelled_during_run(report_progress):
+    worker: Worker
+
+    def fn(progress):
+        progress(0.5)
+        worker.cancel()
+        if report_progress:
+            progress(1.0)
+        return 42
+
+    worker = Worker(fn)
+    emitted = run(worker)
+    assert worker.is_cancelled()
+    assert emitted["progress"] == [0.5]
+    # also a function that finishes after the cancel has no result
+    assert emitted["result"] == []
+    assert len(emitted["cancelled"]) == 1
+    assert len(emitted["finished"]) == 1
+
+
+def test_worker_exception(capsys):
+    def fn(progress):
+        raise ValueError("broken image")
+
+    emitted = run(Worker(fn))
+    assert emitted["result"] == []
+    assert emitted["cancelled"] == []
+    assert len(emitted["finished"]) == 1
+    assert "ValueError: broken image" in capsys.readouterr().err
+
+
+def test_worker_start():
+    threads = []
+    worker = Worker(lambda progress: threads.append(threading.get_ident())).start()
+    QThreadPool.globalInstance().waitForDone()
+    assert not worker.is_cancelled()
+    # it ran on a thread of the pool
+    assert threads and threads[0] != threading.get_ident()